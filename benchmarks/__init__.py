@@ -0,0 +1 @@
+"""Benchmarks for tuyagateway, run from the repository root."""
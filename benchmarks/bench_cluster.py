@@ -0,0 +1,119 @@
+"""Cluster mode: spread, rebalance on join and failover of a crashed node.
+
+Gateway nodes run in this process against the broker stand-in and the
+simulated devices, coordinated through their retained lease topics.
+
+python -m benchmarks.bench_cluster --devices 30 --nodes 3
+"""
+import argparse
+import json
+import time
+from . import fixtures
+from .harness import Harness
+
+
+def _node(harness: Harness, node_id: str, heartbeat: float):
+    from tuyagateway import TuyaMQTT
+
+    config = dict(harness.config)
+    config["Cluster"] = {"node_id": node_id, "heartbeat": str(heartbeat)}
+    node = TuyaMQTT(config)
+    node.mqtt_connect()
+    return node
+
+
+def _running(nodes: list) -> dict:
+    """Return device id -> node ids running it, available devices only."""
+    running = {}
+    for node in nodes:
+        for key, worker in list(node.worker_threads.items()):
+            if worker.is_available():
+                running.setdefault(key, []).append(node.cluster.node_id)
+    return running
+
+
+def _wait_spread(
+    harness: Harness, nodes: list, timeout: float, started: float = None
+) -> float:
+    """Wait till every device runs on the node the hash ring assigns it to."""
+    from tuyagateway.hashring import HashRing
+
+    started = started or time.monotonic()
+    ring = HashRing(node.cluster.node_id for node in nodes)
+    expected = {
+        fixtures.device_id(idx): [ring.get(fixtures.device_id(idx))]
+        for idx in range(harness.devices)
+    }
+    deadline = started + timeout
+    while _running(nodes) != expected:
+        if time.monotonic() > deadline:
+            return None
+        time.sleep(0.05)
+    return time.monotonic() - started
+
+
+def _crash(node):
+    """Drop the node's MQTT connection without leaving the cluster."""
+    node.mqtt_client.loop_stop()
+    node.mqtt_client.socket().close()
+    for worker in list(node.worker_threads.values()):
+        worker.stop_entity()
+
+
+def bench(devices: int, nodes: int, heartbeat: float, timeout: float) -> dict:
+    """Return spread, join and failover times in seconds."""
+    harness = Harness(devices)
+    harness.publish_config()
+    cluster = []
+    try:
+        cluster = [_node(harness, f"node{idx}", heartbeat) for idx in range(nodes)]
+        startup = _wait_spread(harness, cluster, timeout)
+        per_node = {node.cluster.node_id: len(node.worker_threads) for node in cluster}
+
+        cluster.append(_node(harness, f"node{nodes}", heartbeat))
+        join = _wait_spread(harness, cluster, timeout)
+        moved = len(cluster[-1].worker_threads)
+
+        crashed = cluster.pop(0)
+        lost = len(crashed.worker_threads)
+        crashed_at = time.monotonic()
+        _crash(crashed)
+        failover = _wait_spread(harness, cluster, timeout, crashed_at)
+    finally:
+        for node in cluster:
+            node.stop()
+        harness.stop()
+    return {
+        "devices": devices,
+        "nodes": nodes,
+        "heartbeat": heartbeat,
+        "startup_seconds": startup,
+        "devices_per_node": per_node,
+        "join_seconds": join,
+        "join_moved_devices": moved,
+        "failover_seconds": failover,
+        "failover_devices": lost,
+    }
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=30)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--heartbeat", type=float, default=2)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+    from tuyagateway.configure import setup_logging
+
+    setup_logging("WARNING")
+    result = {
+        "benchmark": "cluster",
+        **bench(args.devices, args.nodes, args.heartbeat, args.timeout),
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Python heap per device and per datapoint of Device and Transform.
+
+Devices are configured and have applied a status, as a running gateway
+keeps them. The dict variant keeps the representation from before slots:
+instance dicts, state dicts and lookup tables per datapoint.
+
+python -m benchmarks.bench_memory --devices 1000 --dps 4
+"""
+import argparse
+import json
+import tracemalloc
+from tuyagateway.device import Device, DeviceDataPoint
+from tuyagateway.transform.homeassistant import (
+    Transform,
+    TransformDataPoint,
+    _compile,
+    _EncodedPayload,
+)
+from . import fixtures
+
+
+def _slots_to_dict(obj, cls):
+    """Keep the slot attributes in the instance dict as well."""
+    obj.__dict__.update(
+        {name: getattr(obj, name) for name in cls.__slots__ if hasattr(obj, name)}
+    )
+
+
+class DictDeviceDataPoint(DeviceDataPoint):
+    """DeviceDataPoint with its state and config in dicts."""
+
+    def __init__(self, data_point: dict = None):
+        """Initialize DictDeviceDataPoint."""
+        super().__init__(data_point)
+        self._state_data = {"via": self._via, "changed": self._changed}
+        _slots_to_dict(self, DeviceDataPoint)
+
+    def set_config(self, data_point: dict):
+        """Set the datapoint configuration, the value is kept."""
+        super().set_config(data_point)
+        self._validated_config = (
+            data_point if self._is_valid else {"type_value": "bool"}
+        )
+
+    def set_device_payload(self, data: dict, via: str):
+        """Set the Tuya reply message payload for data point."""
+        super().set_device_payload(data, via)
+        if self._changed:
+            self._state_data = {"via": via, "changed": True}
+        else:
+            self._state_data["changed"] = False
+
+
+class DictDevice(Device):
+    """Device with an instance dict."""
+
+    def __init__(self, device_dict: dict = None):
+        """Initialize DictDevice."""
+        super().__init__(device_dict)
+        _slots_to_dict(self, Device)
+
+    def _init_data_point(self, dp_key: int, data_point: dict = None):
+        self._data_points[dp_key] = DictDeviceDataPoint(data_point)
+
+
+class DictTransformDataPoint(TransformDataPoint):
+    """TransformDataPoint with its own lookup tables and attribute dict."""
+
+    def __init__(self, main, device_key: str, data_point: dict):
+        """Initialize DictTransformDataPoint."""
+        super().__init__(main, device_key, data_point)
+        self._attribute_data = {}
+        self._encoded_attributes = _EncodedPayload()
+
+    def _compile(self):
+        (
+            self._topics_by_type,
+            self._topic_by_type_and_name,
+            self._topic_values,
+            self._command_values,
+        ) = _compile(self.component_config, self.data_point["device_topic"])
+        self._resolve_topics()
+        _slots_to_dict(self, TransformDataPoint)
+
+    def set_attribute_data(self, via: str, changed: bool):
+        """Set device attribute value."""
+        super().set_attribute_data(via, changed)
+        self._attribute_data = {"via": via, "changed": changed}
+        self._encoded_attributes.encode(self._attribute_data)
+
+
+class DictTransform(Transform):
+    """Transform of DictTransformDataPoints."""
+
+    def __init__(self, main, device_config: dict):
+        """Initialize DictTransform."""
+        super().__init__(main, device_config)
+        self._data_points = {
+            dp_value["key"]: DictTransformDataPoint(
+                main, device_config["deviceid"], dp_value
+            )
+            for dp_value in device_config["dps"]
+        }
+
+
+class _Main:
+    """Config source of the transforms, what TuyaMQTT provides."""
+
+    def __init__(self, devices: int, dps: int):
+        self._ha_config = {
+            fixtures.device_id(idx): {
+                dp_key: fixtures.ha_config(idx, dp_key) for dp_key in range(1, dps + 1)
+            }
+            for idx in range(devices)
+        }
+
+    def get_cached_ha_config(self, key: str, idx: int) -> dict:
+        return self._ha_config[key][idx]
+
+    def get_cached_ha_component(self, key: str) -> dict:
+        return fixtures.SWITCH_COMPONENT
+
+
+def _build(main: _Main, discovery: list, device_cls, transform_cls) -> list:
+    devices = []
+    for discover_dict in discovery:
+        device = device_cls(discover_dict)
+        transform = transform_cls(main, discover_dict)
+        for data_point in discover_dict["dps"]:
+            transform.data_point(data_point["key"]).load_config()
+        status = {"dps": {str(dp["key"]): True for dp in discover_dict["dps"]}}
+        device.set_device_payload(status, "status")
+        transform.set_device_state(device.get_device_state())
+        transform.set_gateway_payload(device.get_gateway_payload())
+        for _ in transform.get_publish_content():
+            pass
+        devices.append((device, transform))
+    return devices
+
+
+def bench(devices: int, dps: int, device_cls=Device, transform_cls=Transform) -> dict:
+    """Return heap bytes per device and per datapoint."""
+    main = _Main(devices, dps)
+    # config dicts come from the broker either way, they aren't counted
+    discovery = [fixtures.discovery(idx, dps=dps) for idx in range(devices)]
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    built = _build(main, discovery, device_cls, transform_cls)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    heap = after - before
+    return {
+        "devices": devices,
+        "dps": dps,
+        "bytes_per_device": heap / devices,
+        "bytes_per_datapoint": heap / (devices * dps),
+    }
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--dps", type=int, default=4)
+    args = parser.parse_args()
+    old = bench(args.devices, args.dps, DictDevice, DictTransform)
+    new = bench(args.devices, args.dps)
+    result = {
+        "benchmark": "memory",
+        "devices": args.devices,
+        "dps": args.dps,
+        "dicts": old,
+        "slots": new,
+        "saving": 1 - new["bytes_per_device"] / old["bytes_per_device"],
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
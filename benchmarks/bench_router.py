@@ -0,0 +1,161 @@
+"""Messages/second through TuyaMQTT.on_mqtt_message, if-chain versus router.
+
+Messages are a mix a gateway subscribed to homeassistant/# receives: state
+and discovery of other integrations and a few configs of its own devices.
+Handlers run inline instead of on the control worker, so parsing counts.
+
+python -m benchmarks.bench_router
+"""
+import json
+import time
+import paho.mqtt.client as mqtt
+from tuyagateway import TuyaMQTT
+from tuyagateway.device import Device
+from tuyagateway.transform.homeassistant import Transform
+from . import fixtures
+
+DEVICES = 50
+SECONDS = 2
+
+CONFIG = {"General": {}, "MQTT": {}}
+
+
+class _InlineControl:
+    """Control worker stand-in running handlers on the caller's thread."""
+
+    def submit(self, handler, *args):
+        handler(*args)
+
+    def submit_topic(self, topic: str, handler, *args):
+        handler(*args)
+
+
+class IfChainTuyaMQTT(TuyaMQTT):
+    """TuyaMQTT splitting every topic and parsing configs of any device."""
+
+    def _handle_ha_config_message(self, topic: dict, message):
+        if not message.payload:
+            return
+        try:
+            ha_dict = json.loads(message.payload)
+        except Exception:
+            return
+        ha_dict["device_component"] = topic[1]
+        if "uniq_id" not in ha_dict:
+            return
+        if topic[2] != ha_dict["uniq_id"]:
+            return
+        id_parts = ha_dict["uniq_id"].split("_")
+        if id_parts[0] not in ha_dict["device"]["identifiers"]:
+            return
+        if id_parts[0] not in self._ha_config:
+            self._ha_config[id_parts[0]] = {}
+        if not id_parts[1].isnumeric():
+            return
+        id_int = int(id_parts[1])
+        self._ha_config[id_parts[0]][id_int] = ha_dict
+        self._config_ready.set_ready(("homeassistant", id_parts[0], id_int))
+        transform = self.registry.get_transform(id_parts[0])
+        if transform:
+            transform.set_homeassistant_config(id_int, ha_dict)
+        self.startup.check(id_parts[0])
+
+    def on_mqtt_message(self, client, userdata, message):
+        """MQTT message callback."""
+        topic_parts = message.topic.split("/")
+        if (
+            topic_parts[0] == "homeassistant"
+            and topic_parts[len(topic_parts) - 1] == "config"
+        ):
+            self.control.submit_topic(
+                message.topic, self._handle_ha_config_message, topic_parts, message
+            )
+            return
+        if topic_parts[0] == "tuyagateway":
+            if topic_parts[1] == "config" and topic_parts[2] == "homeassistant":
+                self.control.submit_topic(
+                    message.topic,
+                    self._handle_ha_component_message,
+                    topic_parts,
+                    message,
+                )
+                return
+            if topic_parts[1] == "discovery":
+                self.control.submit_topic(
+                    message.topic, self._handle_discover_message, topic_parts, message
+                )
+                return
+
+
+def _message(topic: str, payload: dict) -> mqtt.MQTTMessage:
+    message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+    message.payload = json.dumps(payload).encode("utf-8")
+    return message
+
+
+def _messages() -> list:
+    """Return the message mix, 1 in 10 is the config of a gateway device."""
+    messages = []
+    for idx in range(DEVICES):
+        foreign = f"0x00158d{idx:08x}"
+        sensor = {
+            "uniq_id": f"{foreign}_temperature",
+            "stat_t": f"zigbee2mqtt/{foreign}",
+            "device": {"identifiers": [foreign]},
+        }
+        messages += [
+            _message(f"homeassistant/sensor/{foreign}/temperature/config", sensor),
+            _message(f"homeassistant/sensor/{foreign}_temperature/config", sensor),
+            _message(f"homeassistant/sensor/{foreign}/state", {"temperature": 21.5}),
+            _message(
+                f"zigbee2mqtt/{foreign}", {"temperature": 21.5, "linkquality": 90}
+            ),
+            _message(f"homeassistant/light/{foreign}/light/config", sensor),
+            _message("tuyagateway/metrics", {"gauges": {}}),
+            _message(f"homeassistant/switch/{foreign}/switch/state", {"state": "ON"}),
+            _message(f"homeassistant/binary_sensor/{foreign}/config", sensor),
+            _message(f"homeassistant/sensor/{foreign}/linkquality/config", sensor),
+            _message(fixtures.ha_config_topic(idx), fixtures.ha_config(idx)),
+        ]
+    return messages
+
+
+def _gateway(cls) -> TuyaMQTT:
+    gateway = cls(CONFIG)
+    gateway.control = _InlineControl()
+    for idx in range(DEVICES):
+        discovery = fixtures.discovery(idx)
+        gateway.registry.add(Device(discovery), Transform(gateway, discovery))
+    return gateway
+
+
+def bench(cls) -> float:
+    """Return messages/second through on_mqtt_message."""
+    gateway = _gateway(cls)
+    messages = _messages()
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < SECONDS:
+        for message in messages:
+            gateway.on_mqtt_message(None, None, message)
+        count += len(messages)
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    old = bench(IfChainTuyaMQTT)
+    new = bench(TuyaMQTT)
+    result = {
+        "benchmark": "router",
+        "unit": "messages/second",
+        "if_chain": old,
+        "router": new,
+        "speedup": new / old,
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Startup cost: import time and time till the first device is online.
+
+Imports are timed in a fresh interpreter each sample. Devices come online
+after a gateway start with their config retained on the broker, as on a
+restart.
+
+python -m benchmarks.bench_startup --devices 20
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from .harness import Harness
+
+MODULES = ["tuyagateway", "tuyagateway.gateway", "tuyagateway.device_thread"]
+
+
+def _import_seconds(module: str, samples: int) -> float:
+    code = (
+        "import time; started = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - started)"
+    )
+    return min(
+        float(
+            subprocess.run(
+                [sys.executable, "-c", code], check=True, stdout=subprocess.PIPE
+            ).stdout
+        )
+        for _ in range(samples)
+    )
+
+
+def bench_online(devices: int, engine: str, timeout: float) -> dict:
+    """Return seconds from gateway start till the first and all devices are online."""
+    harness = Harness(devices, engine)
+    harness.publish_config()
+    try:
+        started = time.monotonic()
+        harness.start_gateway()
+        first = all_online = None
+        if harness.wait_for(lambda: harness.online_count() >= 1, timeout):
+            first = time.monotonic() - started
+        if harness.wait_for(lambda: harness.online_count() == devices, timeout):
+            all_online = time.monotonic() - started
+    finally:
+        harness.stop()
+    return {"first_online_seconds": first, "all_online_seconds": all_online}
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+    from tuyagateway.configure import setup_logging
+
+    setup_logging("WARNING")
+    result = {
+        "benchmark": "startup",
+        "devices": args.devices,
+        "engine": args.engine,
+        "import_seconds": {
+            module: _import_seconds(module, args.samples) for module in MODULES
+        },
+        **bench_online(args.devices, args.engine, args.timeout),
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Per message cost of TransformDataPoint.
+
+Filter scans versus lookup tables, topics built on every message versus
+topics resolved once per config.
+
+python -m benchmarks.bench_transform
+"""
+import json
+import timeit
+from tuyagateway.transform.homeassistant import TransformDataPoint, _lookup
+from . import fixtures
+
+NUMBER = 20000
+
+
+class BuildTopicsTransformDataPoint(TransformDataPoint):
+    """TransformDataPoint building its topics on every message."""
+
+    def _get_topic_value(self, output_topic: dict, data):
+        type_and_name = (output_topic["topic_type"], output_topic["name"])
+        return _lookup(self._topic_values.get(type_and_name, {}), data)
+
+    def _full_topic(self, item: dict):
+        full = item.replace("~", self.homeassistant_config["~"])
+        return {
+            "full": full,
+            "dp_key": self._dp_key,
+            "topic": item.replace("~", ""),
+        }
+
+    def get_subscribe_topics(self) -> dict:
+        """Get the topics to subscribe to for the datapoint."""
+        for output_topic in self._get_topics_by_type("subscribe"):
+            if output_topic["abbreviation"] not in self.homeassistant_config:
+                continue
+            item = self.homeassistant_config[output_topic["abbreviation"]]
+            yield (self._full_topic(item)["full"], 0)
+
+    def get_publish_availability(self, data: bool):
+        """Get the availability topic and ha payload."""
+        output_topic_dict = self._get_topic_by_type_and_name(
+            "publish", "availability_topic"
+        )
+        if not output_topic_dict:
+            return
+        if output_topic_dict["abbreviation"] not in self.homeassistant_config:
+            return
+        return {
+            "topic": self.homeassistant_config[output_topic_dict["abbreviation"]],
+            "payload": self._get_topic_value(output_topic_dict, data),
+        }
+
+    def get_publish_content(self, only_changed: bool = False):
+        """Get the topic and ha payload, optionally only when changed."""
+        if only_changed and not self.is_changed():
+            return
+        for output_topic in self._get_topics_by_type("publish"):
+            if output_topic["abbreviation"] not in self.homeassistant_config:
+                continue
+            if self.data_point["device_topic"] == output_topic["name"]:
+                topic = self._full_topic(output_topic["default_value"])["full"]
+                payload = self._get_topic_value(output_topic, self._state_data)
+                self._command_value = payload
+                yield {"topic": topic, "payload": payload}
+            elif output_topic["name"] == "json_attributes_topic":
+                topic = self._full_topic(output_topic["default_value"])["full"]
+                payload = self._get_attribute_payload()
+                yield {"topic": topic, "payload": payload}
+
+
+class FilterTransformDataPoint(BuildTopicsTransformDataPoint):
+    """TransformDataPoint scanning the component config on every message."""
+
+    def _topic_value(self, output_topic, data):
+        value = list(
+            filter(lambda item: item["tuya_value"] == data, output_topic["values"])
+        )
+        if len(value) == 0:
+            return None
+        return value[0]["default_value"]
+
+    def _get_topic_value(self, output_topic: dict, data):
+        return self._topic_value(output_topic, data)
+
+    def get_gateway_payload(self):
+        """Get payload in gateway format."""
+        command_topic_list = list(
+            filter(
+                lambda item: "publish_topic" in item
+                and item["publish_topic"] == self.data_point["device_topic"],
+                self.component_config["topics"],
+            )
+        )
+        if len(command_topic_list) == 0:
+            return
+        gw_value_list = list(
+            filter(
+                lambda item: item["default_value"] == self._command_value,
+                command_topic_list[0]["values"],
+            )
+        )
+        if len(gw_value_list) == 0:
+            return
+        return gw_value_list[0]["tuya_value"]
+
+    def _get_topics_by_type(self, topic_type: str) -> list:
+        return list(
+            filter(
+                lambda item: item["topic_type"] == topic_type,
+                self.component_config["topics"],
+            )
+        )
+
+    def _get_topic_by_type_and_name(self, topic_type: str, name: str) -> dict:
+        filtered = list(
+            filter(
+                lambda item: item["topic_type"] == topic_type and item["name"] == name,
+                self.component_config["topics"],
+            )
+        )
+        return filtered[0]
+
+
+def _data_point(cls) -> TransformDataPoint:
+    discovery = fixtures.discovery(0)
+    data_point = cls(None, discovery["deviceid"], discovery["dps"][0])
+    data_point.set_homeassistant_config(fixtures.ha_config(0))
+    data_point.set_component_config(fixtures.SWITCH_COMPONENT)
+    return data_point
+
+
+def _per_message(statement) -> float:
+    return min(timeit.repeat(statement, number=NUMBER, repeat=5)) / NUMBER
+
+
+def bench(cls) -> dict:
+    """Return seconds per message for the command and status path."""
+    data_point = _data_point(cls)
+
+    def command():
+        data_point.set_data(b"ON")
+        data_point.get_gateway_payload()
+
+    def status():
+        data_point.set_output_data(True)
+        for _ in data_point.get_publish_content():
+            pass
+
+    def availability():
+        data_point.get_publish_availability(True)
+
+    return {
+        "command": _per_message(command),
+        "status": _per_message(status),
+        "availability": _per_message(availability),
+    }
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    old = bench(FilterTransformDataPoint)
+    lookup = bench(BuildTopicsTransformDataPoint)
+    new = bench(TransformDataPoint)
+    result = {
+        "benchmark": "transform",
+        "unit": "seconds/message",
+        "filter": old,
+        "lookup": lookup,
+        "resolved": new,
+        "speedup": {key: old[key] / new[key] for key in old},
+        "speedup_resolved": {key: lookup[key] / new[key] for key in lookup},
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Minimal in-process MQTT 3.1.1 broker stand-in.
+
+Supports what the gateway uses: CONNECT (with will), SUBSCRIBE and
+UNSUBSCRIBE with + and # wildcards, PUBLISH QoS 0/1 (delivered at QoS 0),
+retained messages, PINGREQ and DISCONNECT. Not meant for production.
+"""
+import asyncio
+import threading
+import time
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Return true if the topic matches the MQTT topic filter."""
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for idx, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if idx >= len(topic_parts):
+            return False
+        if part not in ("+", topic_parts[idx]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        if length:
+            digit |= 0x80
+        encoded.append(digit)
+        if not length:
+            return bytes(encoded)
+
+
+def _string(data: bytes, pos: int) -> tuple:
+    length = int.from_bytes(data[pos : pos + 2], "big")
+    return data[pos + 2 : pos + 2 + length], pos + 2 + length
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([(packet_type << 4) | flags]) + _encode_length(len(body)) + body
+
+
+def publish_packet(topic: str, payload: bytes, retain: bool = False) -> bytes:
+    """Build a QoS 0 PUBLISH packet."""
+    topic_bytes = topic.encode("utf-8")
+    body = len(topic_bytes).to_bytes(2, "big") + topic_bytes + payload
+    return _packet(PUBLISH, 1 if retain else 0, body)
+
+
+class _Session:
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.client_id = ""
+        self.subscriptions = set()
+        self.will = None
+
+    def send(self, data: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class FakeBroker:
+    """MQTT broker stand-in running its own event loop thread."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """Initialize FakeBroker, port 0 picks a free port."""
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.sessions = set()
+        self.retained = {}
+        self.message_count = 0
+        self.listeners = []
+        self._server = None
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="fake_broker", daemon=True
+        )
+
+    def start(self):
+        """Start listening, returns the port."""
+        self._thread.start()
+        future = asyncio.run_coroutine_threadsafe(self._start(), self.loop)
+        future.result(5)
+        return self.port
+
+    async def _start(self):
+        self._server = await asyncio.start_server(self._client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        """Close all sessions and stop the event loop."""
+
+        async def _stop():
+            self._server.close()
+            for session in list(self.sessions):
+                session.writer.close()
+
+        asyncio.run_coroutine_threadsafe(_stop(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(5)
+
+    def add_listener(self, callback: callable):
+        """Call callback(topic, payload, timestamp) for every published message."""
+        self.listeners.append(callback)
+
+    def publish(self, topic: str, payload, retain: bool = False):
+        """Publish from outside the broker, thread safe."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.loop.call_soon_threadsafe(self._route, topic, payload, retain)
+
+    def _route(self, topic: str, payload: bytes, retain: bool):
+        self.message_count += 1
+        now = time.monotonic()
+        for listener in self.listeners:
+            listener(topic, payload, now)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        packet = publish_packet(topic, payload)
+        for session in list(self.sessions):
+            if any(topic_matches(sub, topic) for sub in session.subscriptions):
+                session.send(packet)
+
+    async def _read_packet(self, reader) -> tuple:
+        header = await reader.readexactly(1)
+        multiplier = 1
+        length = 0
+        while True:
+            digit = (await reader.readexactly(1))[0]
+            length += (digit & 0x7F) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        body = await reader.readexactly(length) if length else b""
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def _client(self, reader, writer):
+        session = _Session(self, writer)
+        self.sessions.add(session)
+        clean = False
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == DISCONNECT:
+                    clean = True
+                    break
+                self._handle(session, packet_type, flags, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            if session.will and not clean:
+                self._route(*session.will)
+            writer.close()
+
+    def _handle(self, session: _Session, packet_type: int, flags: int, body: bytes):
+        if packet_type == CONNECT:
+            self._connect(session, body)
+        elif packet_type == PUBLISH:
+            self._publish(session, flags, body)
+        elif packet_type == SUBSCRIBE:
+            self._subscribe(session, body)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, pos = body[:2], 2
+            while pos < len(body):
+                topic_filter, pos = _string(body, pos)
+                session.subscriptions.discard(topic_filter.decode("utf-8"))
+            session.send(_packet(UNSUBACK, 0, packet_id))
+        elif packet_type == PINGREQ:
+            session.send(_packet(PINGRESP, 0, b""))
+
+    def _connect(self, session: _Session, body: bytes):
+        _, pos = _string(body, 0)
+        connect_flags = body[pos + 1]
+        pos += 4
+        client_id, pos = _string(body, pos)
+        session.client_id = client_id.decode("utf-8")
+        if connect_flags & 0x04:
+            will_topic, pos = _string(body, pos)
+            will_payload, pos = _string(body, pos)
+            session.will = (
+                will_topic.decode("utf-8"),
+                will_payload,
+                bool(connect_flags & 0x20),
+            )
+        session.send(_packet(CONNACK, 0, b"\x00\x00"))
+
+    def _publish(self, session: _Session, flags: int, body: bytes):
+        topic, pos = _string(body, 0)
+        qos = (flags >> 1) & 0x03
+        if qos:
+            packet_id = body[pos : pos + 2]
+            pos += 2
+            session.send(_packet(PUBACK, 0, packet_id))
+        self._route(topic.decode("utf-8"), body[pos:], bool(flags & 0x01))
+
+    def _subscribe(self, session: _Session, body: bytes):
+        packet_id, pos = body[:2], 2
+        granted = bytearray()
+        new_filters = []
+        while pos < len(body):
+            topic_filter, pos = _string(body, pos)
+            pos += 1
+            session.subscriptions.add(topic_filter.decode("utf-8"))
+            new_filters.append(topic_filter.decode("utf-8"))
+            granted.append(0)
+        session.send(_packet(SUBACK, 0, packet_id + bytes(granted)))
+        for topic, payload in list(self.retained.items()):
+            if any(topic_matches(sub, topic) for sub in new_filters):
+                session.send(publish_packet(topic, payload, retain=True))
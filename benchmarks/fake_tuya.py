@@ -0,0 +1,174 @@
+"""Simulated Tuya devices speaking protocol 3.1/3.3 on localhost.
+
+Every device listens on its own loopback address (127.0.x.y) at the Tuya
+port 6668, all devices share one event loop thread.
+"""
+import asyncio
+import binascii
+import json
+import threading
+import time
+from tuyaface import aescipher
+from tuyaface.const import CMD_TYPE
+
+TUYA_PORT = 6668
+PREFIX = b"\x00\x00\x55\xaa"
+SUFFIX = b"\x00\x00\xaa\x55"
+HEADER_33 = b"3.3" + b"\0" * 12
+
+
+def loopback_address(idx: int) -> str:
+    """Return the loopback address of device idx, skipping 127.0.0.1."""
+    idx += 2
+    return f"127.0.{idx // 250}.{idx % 250 + 1}"
+
+
+def _frame(seq: int, command: int, payload: bytes = b"", return_code=0) -> bytes:
+    body = (
+        return_code.to_bytes(4, "big") if return_code is not None else b""
+    ) + payload
+    size = len(body) + 8
+    header = PREFIX + seq.to_bytes(4, "big") + command.to_bytes(4, "big")
+    buffer = header + size.to_bytes(4, "big") + body
+    return buffer + (binascii.crc32(buffer) & 0xFFFFFFFF).to_bytes(4, "big") + SUFFIX
+
+
+class FakeTuyaDevice:
+    """State and protocol handling of one simulated device."""
+
+    def __init__(self, device_id: str, localkey: str, protocol: str = "3.3"):
+        """Initialize FakeTuyaDevice."""
+        self.device_id = device_id
+        self.localkey = localkey
+        self.protocol = protocol
+        self.dps = {"1": False}
+        self.writers = set()
+        self.commands = []
+        self.on_command = None
+
+    def _decrypt(self, command: int, payload: bytes) -> dict:
+        if not payload:
+            return {}
+        if self.protocol == "3.3":
+            if command != CMD_TYPE.DP_QUERY:
+                payload = payload[len(HEADER_33) :]
+            return json.loads(aescipher.decrypt(self.localkey, payload, False))
+        if payload[:3] == b"3.1":
+            return json.loads(aescipher.decrypt(self.localkey, payload[19:]))
+        return json.loads(payload)
+
+    def _encrypt(self, command: int, data: dict) -> bytes:
+        raw = json.dumps(data).encode("utf-8")
+        if self.protocol == "3.1":
+            return raw
+        crypted = aescipher.encrypt(self.localkey, raw, False)
+        if command == CMD_TYPE.STATUS:
+            return HEADER_33 + crypted
+        return crypted
+
+    def status_frame(self, dps: dict, seq: int = 0) -> bytes:
+        """Return a STATUS push frame."""
+        data = {"devId": self.device_id, "dps": dps, "t": int(time.time())}
+        return _frame(seq, CMD_TYPE.STATUS, self._encrypt(CMD_TYPE.STATUS, data))
+
+    def handle(self, seq: int, command: int, payload: bytes) -> bytes:
+        """Return the reply frames of a request frame."""
+        if command == CMD_TYPE.HEART_BEAT:
+            return _frame(seq, command)
+        if command == CMD_TYPE.DP_QUERY:
+            data = {"devId": self.device_id, "dps": self.dps}
+            return _frame(seq, command, self._encrypt(command, data))
+        if command == CMD_TYPE.CONTROL_NEW:
+            return _frame(seq, command) + self.status_frame(self.dps)
+        if command == CMD_TYPE.CONTROL:
+            request = self._decrypt(command, payload)
+            changed = {
+                key: value
+                for key, value in request.get("dps", {}).items()
+                if self.dps.get(key) != value
+            }
+            self.dps.update(request.get("dps", {}))
+            self.commands.append((time.monotonic(), request.get("dps", {})))
+            if self.on_command:
+                self.on_command(self, request.get("dps", {}))
+            reply = _frame(seq, command)
+            if changed:
+                reply += self.status_frame(changed)
+            return reply
+        return _frame(seq, command)
+
+
+class FakeTuyaFleet:
+    """Run simulated devices on one event loop thread."""
+
+    def __init__(self):
+        """Initialize FakeTuyaFleet."""
+        self.loop = asyncio.new_event_loop()
+        self.devices = {}
+        self._servers = []
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="fake_tuya", daemon=True
+        )
+        self._thread.start()
+
+    def add_device(
+        self, ip_address: str, device_id: str, localkey: str, protocol: str = "3.3"
+    ) -> FakeTuyaDevice:
+        """Start a device listening on ip_address."""
+        device = FakeTuyaDevice(device_id, localkey, protocol)
+        future = asyncio.run_coroutine_threadsafe(
+            self._serve(ip_address, device), self.loop
+        )
+        future.result(5)
+        self.devices[ip_address] = device
+        return device
+
+    async def _serve(self, ip_address: str, device: FakeTuyaDevice):
+        async def client(reader, writer):
+            await self._client(device, reader, writer)
+
+        server = await asyncio.start_server(client, ip_address, TUYA_PORT)
+        self._servers.append(server)
+
+    async def _client(self, device: FakeTuyaDevice, reader, writer):
+        device.writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(16)
+                seq = int.from_bytes(header[4:8], "big")
+                command = int.from_bytes(header[8:12], "big")
+                size = int.from_bytes(header[12:16], "big")
+                body = await reader.readexactly(size)
+                # body: payload + crc + suffix
+                writer.write(device.handle(seq, command, body[:-8]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            device.writers.discard(writer)
+            writer.close()
+
+    def push_status(self, ip_address: str, dps: dict):
+        """Let the device push a status change to its connections."""
+        device = self.devices[ip_address]
+
+        def push():
+            device.dps.update(dps)
+            frame = device.status_frame(dps)
+            for writer in list(device.writers):
+                writer.write(frame)
+
+        self.loop.call_soon_threadsafe(push)
+
+    def stop(self):
+        """Stop all devices."""
+
+        async def _stop():
+            for server in self._servers:
+                server.close()
+            for device in self.devices.values():
+                for writer in list(device.writers):
+                    writer.close()
+
+        asyncio.run_coroutine_threadsafe(_stop(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(5)
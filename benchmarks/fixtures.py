@@ -0,0 +1,101 @@
+"""Sample GismoCaster and Home Assistant configuration."""
+
+LOCALKEY = "0123456789abcdef"
+
+SWITCH_COMPONENT = {
+    "topics": [
+        {
+            "name": "state_topic",
+            "topic_type": "publish",
+            "abbreviation": "stat_t",
+            "default_value": "~/state",
+            "values": [
+                {"tuya_value": True, "default_value": "ON"},
+                {"tuya_value": False, "default_value": "OFF"},
+            ],
+        },
+        {
+            "name": "command_topic",
+            "topic_type": "subscribe",
+            "abbreviation": "cmd_t",
+            "default_value": "~/command",
+            "publish_topic": "state_topic",
+            "values": [
+                {"tuya_value": True, "default_value": "ON"},
+                {"tuya_value": False, "default_value": "OFF"},
+            ],
+        },
+        {
+            "name": "availability_topic",
+            "topic_type": "publish",
+            "abbreviation": "avty_t",
+            "default_value": "~/availability",
+            "values": [
+                {"tuya_value": True, "default_value": "online"},
+                {"tuya_value": False, "default_value": "offline"},
+            ],
+        },
+        {
+            "name": "json_attributes_topic",
+            "topic_type": "publish",
+            "abbreviation": "json_attr_t",
+            "default_value": "~/attributes",
+            "values": [],
+        },
+    ]
+}
+
+
+def device_id(idx: int) -> str:
+    """Return the device id of sample device idx."""
+    return f"bench{idx:06d}"
+
+
+def discovery(idx: int, ip_address: str = "127.0.0.1", dps: int = 1) -> dict:
+    """Return a GismoCaster discovery payload."""
+    return {
+        "deviceid": device_id(idx),
+        "localkey": LOCALKEY,
+        "ip": ip_address,
+        "protocol": "3.3",
+        "pref_status_cmd": 10,
+        "dps": [
+            {
+                "key": dp_key,
+                "type_value": "bool",
+                "device_component": "switch",
+                "device_topic": "state_topic",
+            }
+            for dp_key in range(1, dps + 1)
+        ],
+    }
+
+
+def ha_config(idx: int, dp_key: int = 1) -> dict:
+    """Return a Home Assistant discovery config of a datapoint."""
+    key = device_id(idx)
+    return {
+        "~": f"tuya/{key}/{dp_key}",
+        "name": f"{key} {dp_key}",
+        "uniq_id": f"{key}_{dp_key}",
+        "stat_t": "~/state",
+        "cmd_t": "~/command",
+        "avty_t": f"tuya/{key}/availability",
+        "json_attr_t": "~/attributes",
+        "device": {"identifiers": [key]},
+    }
+
+
+def ha_config_topic(idx: int, dp_key: int = 1) -> str:
+    """Return the Home Assistant discovery topic of a datapoint."""
+    return f"homeassistant/switch/{device_id(idx)}_{dp_key}/config"
+
+
+def command_topic(idx: int, dp_key: int = 1) -> str:
+    """Return the command topic of a datapoint."""
+    return f"tuya/{device_id(idx)}/{dp_key}/command"
+
+
+def state_topic(idx: int, dp_key: int = 1) -> str:
+    """Return the state topic of a datapoint."""
+    return f"tuya/{device_id(idx)}/{dp_key}/state"
@@ -0,0 +1,97 @@
+"""Gateway, simulated devices and broker stand-in wired together."""
+import json
+import threading
+import time
+from . import fixtures
+from .fake_broker import FakeBroker
+from .fake_tuya import FakeTuyaFleet, loopback_address
+
+
+class Harness:
+    """Run TuyaMQTT against a FakeBroker and a FakeTuyaFleet."""
+
+    def __init__(self, devices: int, engine: str = "thread", general: dict = None):
+        """Initialize Harness, starts broker and simulated devices."""
+        self.devices = devices
+        self.broker = FakeBroker()
+        port = self.broker.start()
+        self.fleet = FakeTuyaFleet()
+        for idx in range(devices):
+            self.fleet.add_device(
+                loopback_address(idx), fixtures.device_id(idx), fixtures.LOCALKEY
+            )
+        self.config = {
+            "General": {"engine": engine, **(general or {})},
+            "MQTT": {"user": None, "pass": None, "host": "127.0.0.1", "port": port},
+        }
+        self.gateway = None
+        self.last_publish = {}
+        self._condition = threading.Condition()
+        self.broker.add_listener(self._on_publish)
+
+    def _on_publish(self, topic: str, payload: bytes, timestamp: float):
+        with self._condition:
+            self.last_publish[topic] = (timestamp, payload)
+            self._condition.notify_all()
+
+    def wait_for(self, predicate: callable, timeout: float = 30) -> bool:
+        """Wait till predicate() is true, checked on every publish."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(min(remaining, 0.5))
+        return True
+
+    def publish_config(self, indexes=None):
+        """Publish retained component, Home Assistant and discovery config."""
+        if indexes is None:
+            indexes = range(self.devices)
+        self.broker.publish(
+            "tuyagateway/config/homeassistant/switch",
+            json.dumps(fixtures.SWITCH_COMPONENT),
+            retain=True,
+        )
+        for idx in indexes:
+            self.broker.publish(
+                fixtures.ha_config_topic(idx), json.dumps(fixtures.ha_config(idx)), True
+            )
+            self.publish_discovery(idx)
+
+    def publish_discovery(self, idx: int, discovery: dict = None):
+        """Publish the retained discovery message of device idx."""
+        if discovery is None:
+            discovery = fixtures.discovery(idx, loopback_address(idx))
+        self.broker.publish(
+            f"tuyagateway/discovery/{fixtures.device_id(idx)}",
+            json.dumps(discovery),
+            retain=True,
+        )
+
+    def availability(self, idx: int) -> bytes:
+        """Return the last published availability of device idx."""
+        topic = f"tuya/{fixtures.device_id(idx)}/availability"
+        return self.last_publish.get(topic, (None, None))[1]
+
+    def online_count(self) -> int:
+        """Return the number of devices published online."""
+        return sum(
+            1 for idx in range(self.devices) if self.availability(idx) == b"online"
+        )
+
+    def start_gateway(self):
+        """Start TuyaMQTT without its main loop."""
+        from tuyagateway import TuyaMQTT
+
+        self.gateway = TuyaMQTT(self.config)
+        self.gateway.mqtt_connect()
+        return self.gateway
+
+    def stop(self):
+        """Stop gateway, devices and broker."""
+        if self.gateway:
+            self.gateway.stop()
+        self.fleet.stop()
+        self.broker.stop()
@@ -0,0 +1,198 @@
+"""End to end benchmarks of TuyaMQTT, results are printed as JSON.
+
+python -m benchmarks.run --devices 20 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import runpy
+import sys
+import threading
+import time
+import tracemalloc
+from . import fixtures
+from .fake_tuya import loopback_address
+from .harness import Harness
+
+
+def _summary(values: list) -> dict:
+    """Return count, mean and percentiles in seconds."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": ordered[-1],
+    }
+
+
+def _rss_bytes() -> int:
+    """Return the resident set size of the process, None if unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def bench_startup(harness: Harness, timeout: float) -> dict:
+    """Time a retained discovery burst till all devices are online."""
+    harness.publish_config()
+    rss_before = _rss_bytes()
+    threads_before = threading.active_count()
+    tracemalloc.start()
+    started = time.monotonic()
+    harness.start_gateway()
+    online = harness.wait_for(
+        lambda: harness.online_count() == harness.devices, timeout
+    )
+    elapsed = time.monotonic() - started
+    heap, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = _rss_bytes()
+    result = {
+        "all_online": online,
+        "online": harness.online_count(),
+        "discovery_burst_seconds": elapsed,
+        "python_heap_bytes_per_device": heap / harness.devices,
+        "threads": threading.active_count() - threads_before,
+    }
+    if rss_before is not None and rss_after is not None:
+        result["rss_bytes_per_device"] = (rss_after - rss_before) / harness.devices
+    return result
+
+
+def bench_command_latency(harness: Harness, samples: int) -> dict:
+    """Time MQTT command publish till the device received the command."""
+    received = threading.Event()
+    for device in harness.fleet.devices.values():
+        device.on_command = lambda device, dps: received.set()
+
+    latencies = []
+    for sample in range(samples):
+        idx = sample % harness.devices
+        device = harness.fleet.devices[loopback_address(idx)]
+        count = len(device.commands)
+        received.clear()
+        started = time.monotonic()
+        harness.broker.publish(
+            fixtures.command_topic(idx), "ON" if sample % 2 == 0 else "OFF"
+        )
+        deadline = started + 5
+        while len(device.commands) == count and time.monotonic() < deadline:
+            received.wait(0.5)
+        if len(device.commands) > count:
+            latencies.append(device.commands[count][0] - started)
+    return _summary(latencies)
+
+
+def bench_status_latency(harness: Harness, samples: int) -> dict:
+    """Time device status push till the gateway published the state."""
+    latencies = []
+    for sample in range(samples):
+        idx = sample % harness.devices
+        ip_address = loopback_address(idx)
+        value = not harness.fleet.devices[ip_address].dps.get("1")
+        expected = b"ON" if value else b"OFF"
+        topic = fixtures.state_topic(idx)
+        started = time.monotonic()
+        harness.fleet.push_status(ip_address, {"1": value})
+
+        def published():
+            item = harness.last_publish.get(topic)
+            return item is not None and item[0] >= started and item[1] == expected
+
+        if harness.wait_for(published, 5):
+            latencies.append(harness.last_publish[topic][0] - started)
+    return _summary(latencies)
+
+
+def bench_max_devices(steps: list, engine: str, timeout: float) -> dict:
+    """Largest device count of the steps that came online within timeout."""
+    result = {"timeout_seconds": timeout, "steps": {}, "max_devices": 0}
+    for devices in steps:
+        harness = Harness(devices, engine)
+        try:
+            startup = bench_startup(harness, timeout)
+        finally:
+            harness.stop()
+        result["steps"][devices] = startup["discovery_burst_seconds"]
+        if not startup["all_online"]:
+            break
+        result["max_devices"] = devices
+    return result
+
+
+def run(args) -> dict:
+    """Run all benchmarks, return the results."""
+    harness = Harness(args.devices, args.engine)
+    try:
+        startup = bench_startup(harness, args.timeout)
+        results = {"startup": startup}
+        if startup["all_online"]:
+            results["command_latency"] = bench_command_latency(harness, args.samples)
+            results["status_to_publish_latency"] = bench_status_latency(
+                harness, args.samples
+            )
+        results["broker_messages"] = harness.broker.message_count
+    finally:
+        harness.stop()
+
+    if args.max_devices:
+        steps = [int(step) for step in args.max_devices.split(",")]
+        results["max_devices"] = bench_max_devices(steps, args.engine, args.timeout)
+
+    return {
+        "benchmark": "gateway",
+        "version": runpy.run_path("version.py")["__version__"],
+        "python": platform.python_version(),
+        "engine": args.engine,
+        "devices": args.devices,
+        "unit": "seconds",
+        "results": results,
+    }
+
+
+def parse_args(argv: list):
+    """Parse the benchmark arguments."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument(
+        "--max-devices",
+        default="",
+        help="comma separated device counts to ramp, e.g. 50,100,200",
+    )
+    parser.add_argument("--output", help="write JSON results to file")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None):
+    """Run the benchmarks and print the results as JSON."""
+    from tuyagateway.configure import setup_logging
+
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    setup_logging(args.log_level)
+    result = run(args)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    print(output)
+    return result
+
+
+if __name__ == "__main__":
+    main()
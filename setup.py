@@ -68,7 +68,7 @@ setup(
         "Topic :: Home Automation",
     ],
     keywords="home automation, mqtt, auto discovery, tuya",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     platforms="any",
     install_requires=parse_requirements("requirements.txt"),
 )
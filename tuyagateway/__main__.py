@@ -0,0 +1,5 @@
+"""Run the gateway with python -m tuyagateway."""
+from . import main
+
+if __name__ == "__main__":
+    main()
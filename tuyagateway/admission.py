@@ -0,0 +1,194 @@
+"""AdmissionController, gateway wide limit on concurrent Tuya socket operations."""
+import asyncio
+import collections
+import contextlib
+import ipaddress
+import threading
+import time
+from .metrics import gauge, histogram
+
+ADMISSION_WAIT = histogram(
+    "admission_wait_seconds",
+    "Time Tuya operations waited for an admission slot.",
+    labelnames=("operation",),
+)
+ADMISSION_IN_FLIGHT = gauge("admission_in_flight", "Admitted Tuya operations.")
+ADMISSION_WAITING = gauge("admission_waiting", "Tuya operations waiting for a slot.")
+
+
+class AdmissionController:
+    """Admit Tuya connects and requests within global and per subnet limits.
+
+    Waiting operations are granted round robin between devices, so one busy
+    device can't starve the others. request() calls grant() once admitted,
+    possibly from another thread, every grant needs a release().
+    """
+
+    def __init__(self, config: dict):
+        """Initialize AdmissionController."""
+        general = config["General"]
+        self.max_in_flight = int(general.get("admission_max", 0))
+        self.subnet_max = int(general.get("admission_subnet_max", 0))
+        self.subnet_prefix = int(general.get("admission_subnet_prefix", 24))
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._subnet_in_flight = collections.Counter()
+        self._subnets = {}
+        # device key -> deque of (subnet, grant), in round robin order
+        self._waiting = collections.OrderedDict()
+        ADMISSION_IN_FLIGHT.set_function(lambda: self._in_flight)
+        ADMISSION_WAITING.set_function(
+            lambda: sum(len(items) for items in list(self._waiting.values()))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """Return true if any limit is configured."""
+        return bool(self.max_in_flight or self.subnet_max)
+
+    def _subnet(self, ip_address: str) -> str:
+        subnet = self._subnets.get(ip_address)
+        if subnet is None:
+            try:
+                subnet = str(
+                    ipaddress.ip_network(
+                        f"{ip_address}/{self.subnet_prefix}", strict=False
+                    )
+                )
+            except ValueError:
+                subnet = ip_address
+            self._subnets[ip_address] = subnet
+        return subnet
+
+    def _has_capacity(self, subnet: str) -> bool:
+        if self.max_in_flight and self._in_flight >= self.max_in_flight:
+            return False
+        if self.subnet_max and self._subnet_in_flight[subnet] >= self.subnet_max:
+            return False
+        return True
+
+    def _take(self, subnet: str):
+        self._in_flight += 1
+        self._subnet_in_flight[subnet] += 1
+
+    def _next_grants(self) -> list:
+        """Pop the waiting operations that fit, round robin over devices."""
+        grants = []
+        progress = True
+        while progress and self._waiting:
+            progress = False
+            for key in list(self._waiting):
+                items = self._waiting[key]
+                subnet, grant = items[0]
+                if not self._has_capacity(subnet):
+                    continue
+                items.popleft()
+                self._take(subnet)
+                grants.append(grant)
+                progress = True
+                if items:
+                    self._waiting.move_to_end(key)
+                else:
+                    del self._waiting[key]
+        return grants
+
+    def request(self, key: str, ip_address: str, grant: callable) -> str:
+        """Ask for a slot, grant() is called once admitted.
+
+        Returns the ticket to pass to release() and cancel().
+        """
+        subnet = self._subnet(ip_address)
+        with self._lock:
+            self._waiting.setdefault(key, collections.deque()).append((subnet, grant))
+            # free capacity is granted right away, also to other subnets
+            grants = self._next_grants()
+        for item in grants:
+            item()
+        return subnet
+
+    def release(self, ticket: str):
+        """Give back the slot of a granted request."""
+        with self._lock:
+            self._in_flight -= 1
+            self._subnet_in_flight[ticket] -= 1
+            grants = self._next_grants()
+        for grant in grants:
+            grant()
+
+    def cancel(self, key: str, ticket: str, grant: callable) -> bool:
+        """Withdraw a waiting request, false if it was granted already."""
+        with self._lock:
+            items = self._waiting.get(key)
+            if not items or (ticket, grant) not in items:
+                return False
+            items.remove((ticket, grant))
+            if not items:
+                del self._waiting[key]
+            return True
+
+    @contextlib.contextmanager
+    def slot(
+        self, key: str, ip_address: str, operation: str, stop: threading.Event = None,
+    ):
+        """Hold a slot while in the with block, yields false if stopped first."""
+        if not self.enabled:
+            yield True
+            return
+        started = time.monotonic()
+        granted = threading.Event()
+        ticket = self.request(key, ip_address, granted.set)
+        while not granted.wait(0.5):
+            if stop is not None and stop.is_set():
+                if self.cancel(key, ticket, granted.set):
+                    yield False
+                    return
+        ADMISSION_WAIT.labels(operation).observe(time.monotonic() - started)
+        try:
+            yield True
+        finally:
+            self.release(ticket)
+
+    def async_slot(self, key: str, ip_address: str, operation: str):
+        """Return an async context manager holding a slot."""
+        return _AsyncSlot(self, key, ip_address, operation)
+
+
+class _AsyncSlot:
+    """async with counterpart of AdmissionController.slot."""
+
+    def __init__(self, controller, key: str, ip_address: str, operation: str):
+        self._controller = controller
+        self._key = key
+        self._ip_address = ip_address
+        self._operation = operation
+        self._ticket = None
+
+    async def __aenter__(self):
+        if not self._controller.enabled:
+            return True
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def _set_granted():
+            if not future.done():
+                future.set_result(True)
+
+        def grant():
+            loop.call_soon_threadsafe(_set_granted)
+
+        ticket = self._controller.request(self._key, self._ip_address, grant)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not self._controller.cancel(self._key, ticket, grant):
+                self._controller.release(ticket)
+            raise
+        self._ticket = ticket
+        ADMISSION_WAIT.labels(self._operation).observe(time.monotonic() - started)
+        return True
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if self._ticket is not None:
+            self._controller.release(self._ticket)
+            self._ticket = None
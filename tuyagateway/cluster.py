@@ -0,0 +1,231 @@
+"""ClusterMembership, spreads the devices over gateway nodes through the broker."""
+import threading
+import time
+from . import codec
+from .configure import logger
+from .hashring import HashRing
+from .metrics import gauge
+
+CLUSTER_NODES = gauge("cluster_nodes", "Live gateway nodes in the cluster.")
+CLUSTER_DEVICES = gauge("cluster_devices", "Devices owned by this node.")
+
+
+class ClusterMembership(threading.Thread):
+    """Own a share of the devices, coordinated with retained MQTT topics.
+
+    Every node publishes a retained heartbeat on <topic>/nodes/<node id>, a
+    node without heartbeat for expiry seconds is gone (its will clears the
+    topic sooner if its connection drops). Retained heartbeats may be left
+    by a gone node, only live ones count, so a node waits settle seconds
+    (more than a heartbeat) to learn the others before claiming devices. Devices are spread over the live
+    nodes by consistent hashing. The owner claims a device with a retained
+    lease on <topic>/leases/<device id> and only starts it once the lease
+    is free, its own or held by a gone node. Devices that moved to another
+    node are stopped and their lease is released.
+
+    keys() returns the known device ids, acquire(key) and release(key) start
+    and stop a device, they are called from the cluster thread.
+    """
+
+    def __init__(
+        self, config: dict, mqtt, keys: callable, acquire: callable, release: callable,
+    ):
+        """Initialize ClusterMembership."""
+        super().__init__(name="tuyagateway_cluster", daemon=True)
+        section = config["Cluster"] if "Cluster" in config else {}
+        self.node_id = section.get("node_id", "")
+        self.topic = section.get("topic", "tuyagateway/cluster")
+        self.heartbeat = float(section.get("heartbeat", 2))
+        self.expiry = float(section.get("expiry", 3 * self.heartbeat))
+        self.settle = float(section.get("settle", self.heartbeat + 1))
+        self._mqtt = mqtt
+        self._keys = keys
+        self._acquire = acquire
+        self._release = release
+        self._condition = threading.Condition()
+        # node id -> monotonic time of its last heartbeat
+        self._nodes = {}
+        # device id -> node id holding the lease
+        self._leases = {}
+        self._owned = set()
+        self._members = set()
+        self._ring = HashRing()
+        self._changed = False
+        self._stopping = False
+        CLUSTER_NODES.set_function(lambda: len(self._members))
+        CLUSTER_DEVICES.set_function(lambda: len(self._owned))
+
+    @property
+    def enabled(self) -> bool:
+        """Return true if a node id is configured."""
+        return bool(self.node_id)
+
+    def topics(self) -> list:
+        """Return the subscriptions of the cluster topics."""
+        return [(f"{self.topic}/nodes/+", 0), (f"{self.topic}/leases/+", 0)]
+
+    def _node_topic(self, node: str) -> str:
+        return f"{self.topic}/nodes/{node}"
+
+    def _lease_topic(self, key: str) -> str:
+        return f"{self.topic}/leases/{key}"
+
+    def set_will(self):
+        """Clear the heartbeat of this node when its connection drops.
+
+        The will replaces the gateway status will of the gateway's own
+        connection, the pool keeps another connection for the status.
+        """
+        self._mqtt.set_will(self._node_topic(self.node_id), b"")
+
+    def owns(self, key: str) -> bool:
+        """Return true if this node runs the device."""
+        return key in self._owned
+
+    def _wake(self):
+        self._changed = True
+        self._condition.notify()
+
+    def notify(self):
+        """Rebalance soon, for example after a device was discovered."""
+        with self._condition:
+            self._wake()
+
+    def on_node_message(self, topic_parts: list, message):
+        """Handle a heartbeat of another node."""
+        node = topic_parts[-1]
+        if node == self.node_id:
+            return
+        with self._condition:
+            if not message.payload:
+                if self._nodes.pop(node, None) is not None:
+                    self._wake()
+                return
+            if message.retain:
+                # sent before we subscribed, maybe by a node that is gone
+                return
+            if node not in self._nodes:
+                self._wake()
+            self._nodes[node] = time.monotonic()
+
+    def on_lease_message(self, topic_parts: list, message):
+        """Track the lease of a device."""
+        key = topic_parts[-1]
+        node = message.payload.decode("utf-8") if message.payload else ""
+        with self._condition:
+            if node:
+                self._leases[key] = node
+            else:
+                self._leases.pop(key, None)
+            self._wake()
+
+    def _live_nodes(self) -> set:
+        now = time.monotonic()
+        for node, seen in list(self._nodes.items()):
+            if now - seen > self.expiry:
+                logger.warning("cluster node %s missed its heartbeats", node)
+                del self._nodes[node]
+        return set(self._nodes) | {self.node_id}
+
+    def _balance(self, heartbeat: bool) -> tuple:
+        """Return the devices to start, to stop and the leases to publish."""
+        members = self._live_nodes()
+        if members != self._members:
+            logger.info("cluster nodes %s", ", ".join(sorted(members)))
+            self._members = members
+            self._ring = HashRing(members)
+        acquire, release, leases = [], [], []
+        keys = set(self._keys())
+        for key in keys:
+            lease = self._leases.get(key)
+            if self._ring.get(key) != self.node_id:
+                if key in self._owned:
+                    self._owned.discard(key)
+                    release.append(key)
+                if lease == self.node_id:
+                    # released right away, else every rebalance till the echo
+                    del self._leases[key]
+                    leases.append((key, ""))
+                continue
+            if key in self._owned:
+                if lease not in (None, self.node_id) and lease in members:
+                    # claimed at the same time, the retained lease won
+                    self._owned.discard(key)
+                    release.append(key)
+                elif lease != self.node_id and heartbeat:
+                    # the claim was lost, claim again
+                    leases.append((key, self.node_id))
+                continue
+            if lease in (None, self.node_id) or lease not in members:
+                self._owned.add(key)
+                acquire.append(key)
+                leases.append((key, self.node_id))
+        for key in self._owned - keys:
+            self._owned.discard(key)
+            self._leases.pop(key, None)
+            release.append(key)
+            leases.append((key, ""))
+        return acquire, release, leases
+
+    def _publish_leases(self, leases: list):
+        for key, node in leases:
+            self._mqtt.publish_gateway(self._lease_topic(key), node, retain=True)
+
+    def run(self):
+        """Heartbeat and rebalance loop."""
+        started = time.monotonic()
+        last_heartbeat = None
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                self._changed = False
+                now = time.monotonic()
+                heartbeat = (
+                    last_heartbeat is None or now - last_heartbeat >= self.heartbeat
+                )
+                if heartbeat:
+                    last_heartbeat = now
+                acquire, release, leases = [], [], []
+                if now - started >= self.settle:
+                    acquire, release, leases = self._balance(heartbeat)
+            # paho holds its callback lock while our message handlers wait for
+            # the condition, publishing under the condition could deadlock
+            if heartbeat:
+                self._mqtt.publish_gateway(
+                    self._node_topic(self.node_id),
+                    codec.dumps({"node": self.node_id, "time": time.time()}),
+                    retain=True,
+                )
+            # queue stopping moved devices before releasing their leases
+            for key in release:
+                self._release(key)
+            self._publish_leases(leases)
+            for key in acquire:
+                self._acquire(key)
+            with self._condition:
+                if self._stopping:
+                    return
+                wait = last_heartbeat + self.heartbeat - time.monotonic()
+                if now - started < self.settle:
+                    wait = min(wait, started + self.settle - time.monotonic())
+                if not self._changed:
+                    self._condition.wait(max(0, wait))
+
+    def stop(self):
+        """Stop rebalancing, the devices stay owned till leave()."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def leave(self):
+        """Leave the cluster, the other nodes take over right away.
+
+        Call once the devices are stopped, many devices accept only one
+        local connection.
+        """
+        owned, self._owned = self._owned, set()
+        self._publish_leases([(key, "") for key in owned])
+        self._mqtt.publish_gateway(self._node_topic(self.node_id), b"", retain=True)
@@ -0,0 +1,82 @@
+"""JSON codec, uses orjson or ujson when installed, else the standard library.
+
+loads() takes bytes or str, dumps() returns UTF-8 bytes ready to publish.
+"""
+import json
+from .configure import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _orjson_dumps(obj) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _ujson_dumps(obj) -> bytes:
+    return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+CODECS = {"json": (json.loads, _json_dumps)}
+if ujson:
+    CODECS["ujson"] = (ujson.loads, _ujson_dumps)
+if orjson:
+    CODECS["orjson"] = (orjson.loads, _orjson_dumps)
+
+
+class _Backend:
+    """The codec in use, selected by use()."""
+
+    def __init__(self):
+        """Initialize _Backend."""
+        self.name = None
+        self.loads = None
+        self.dumps = None
+
+
+_BACKEND = _Backend()
+
+
+def loads(data):
+    """Decode JSON bytes or str."""
+    return _BACKEND.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """Encode to JSON as UTF-8 bytes."""
+    return _BACKEND.dumps(obj)
+
+
+def compact(payload: bytes) -> bytes:
+    """Return the payload without spare buffer, for payloads that are kept.
+
+    orjson allocates about 1KB for any payload and keeps it.
+    """
+    if _BACKEND.name == "orjson":
+        return memoryview(payload).tobytes()
+    return payload
+
+
+def use(name: str = "auto"):
+    """Select the codec by name, auto picks the fastest installed."""
+    if name == "auto":
+        name = next(item for item in ("orjson", "ujson", "json") if item in CODECS)
+    elif name not in CODECS:
+        logger.warning("json codec %s not installed, using json", name)
+        name = "json"
+    _BACKEND.name = name
+    _BACKEND.loads, _BACKEND.dumps = CODECS[name]
+
+
+use()
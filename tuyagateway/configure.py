@@ -1,8 +1,14 @@
-"""Read commandline params."""
+"""Read config files and commandline params."""
 import argparse
 import configparser
 import logging
 
+CONFIG_FILES = [
+    "./etc/tuyagateway.conf",
+    "/usr/local/etc/tuyagateway.conf",
+    "/etc/tuyagateway.conf",
+]
+
 DEFAULTS = {
     "General": {
         "topic": "tuya",
@@ -14,70 +20,97 @@ DEFAULTS = {
     "MQTT": {"user": None, "pass": None, "host": "127.0.0.1", "port": 1883},
 }
 
-CONFIG = DEFAULTS
+LOG_LEVELS = {
+    "INFO": logging.INFO,
+    "WARN": logging.WARN,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "DEBUG": logging.DEBUG,
+}
 
-try:
-    CONFIG = configparser.ConfigParser()
-    CONFIG.read(
-        [
-            "./etc/tuyagateway.conf",
-            "/usr/local/etc/tuyagateway.conf",
-            "/etc/tuyagateway.conf",
-        ]
-    )
-except Exception:
-    CONFIG = DEFAULTS
-
-
-CURRENT = {"General": dict(CONFIG["General"]), "MQTT": dict(CONFIG["MQTT"])}
-
-PARSER = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-PARSER.add_argument(
-    "-ll", help="Log level [INFO|WARN|ERROR|DEBUG]", type=str, default="INFO"
-)
-PARSER.add_argument("-cf", "--config_file", help="config file", type=str)
-PARSER.add_argument(
-    "-H", "--host", help="MQTT Host", default=CONFIG["MQTT"]["host"], type=str
-)
-PARSER.add_argument(
-    "-P", "--port", help="MQTT Port", default=CONFIG["MQTT"]["port"], type=int
-)
-PARSER.add_argument("-U", "--user", help="MQTT User", type=str)
-PARSER.add_argument("-p", "--password", help="MQTT Password", type=str)
-ARGS = PARSER.parse_args()
-
-if ARGS.config_file:
+logger = logging.getLogger(__name__)
+
+
+def _defaults() -> dict:
+    return {name: dict(section) for name, section in DEFAULTS.items()}
+
+
+def read_config(files: list = None):
+    """Read the config files, DEFAULTS if they can't be read."""
     try:
-        CONFIG = configparser.ConfigParser()
-        CONFIG.read([ARGS.config_file])
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILES if files is None else files)
     except Exception:
-        pass
-
-if "MQTT" not in CONFIG:
-    CONFIG = CURRENT
-
-if ARGS.host != CURRENT["MQTT"]["host"]:
-    CONFIG["MQTT"]["host"] = ARGS.host
-if ARGS.port != CURRENT["MQTT"]["port"]:
-    CONFIG["MQTT"]["port"] = str(ARGS.port)
-if ARGS.user != CURRENT["MQTT"]["user"] and ARGS.user:
-    CONFIG["MQTT"]["user"] = ARGS.user
-if ARGS.password != CURRENT["MQTT"]["pass"] and ARGS.password:
-    CONFIG["MQTT"]["pass"] = ARGS.password
-
-
-LOGLEVEL = logging.INFO
-if ARGS.ll == "INFO":
-    LOGLEVEL = logging.INFO
-elif ARGS.ll == "WARN":
-    LOGLEVEL = logging.WARN
-elif ARGS.ll == "ERROR":
-    LOGLEVEL = logging.ERROR
-elif ARGS.ll == "DEBUG":
-    LOGLEVEL = logging.DEBUG
-
-logging.basicConfig(
-    format="%(asctime)s %(levelname)-8s (%(threadName)s) [%(name)s] %(message)s",
-    level=LOGLEVEL,
-)
-logger = logging.getLogger(__name__)
+        return _defaults()
+    if "MQTT" not in config:
+        return _defaults()
+    return config
+
+
+def parse_args(config, argv: list = None) -> argparse.Namespace:
+    """Parse the commandline, sys.argv if argv is None."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-ll", help="Log level [INFO|WARN|ERROR|DEBUG]", type=str, default="INFO"
+    )
+    parser.add_argument("-cf", "--config_file", help="config file", type=str)
+    parser.add_argument(
+        "-H", "--host", help="MQTT Host", default=config["MQTT"]["host"], type=str
+    )
+    parser.add_argument(
+        "-P", "--port", help="MQTT Port", default=config["MQTT"]["port"], type=int
+    )
+    parser.add_argument("-U", "--user", help="MQTT User", type=str)
+    parser.add_argument("-p", "--password", help="MQTT Password", type=str)
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="Device engine [thread|asyncio], default from the config file",
+        choices=["thread", "asyncio"],
+        type=str,
+    )
+    return parser.parse_args(argv)
+
+
+def apply_args(config, args: argparse.Namespace):
+    """Return the config with the commandline params applied."""
+    current = {"General": dict(config["General"]), "MQTT": dict(config["MQTT"])}
+    if args.config_file:
+        try:
+            config = configparser.ConfigParser()
+            config.read([args.config_file])
+        except Exception:
+            pass
+
+    if "MQTT" not in config:
+        config = current
+
+    if args.host != current["MQTT"]["host"]:
+        config["MQTT"]["host"] = args.host
+    if args.port != current["MQTT"]["port"]:
+        config["MQTT"]["port"] = str(args.port)
+    if args.user != current["MQTT"]["user"] and args.user:
+        config["MQTT"]["user"] = args.user
+    if args.password != current["MQTT"]["pass"] and args.password:
+        config["MQTT"]["pass"] = args.password
+    if args.engine:
+        config["General"]["engine"] = args.engine
+    return config
+
+
+def setup_logging(level: str = "INFO"):
+    """Log to stderr at the level, INFO if unknown."""
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s (%(threadName)s) [%(name)s] %(message)s",
+        level=LOG_LEVELS.get(level, logging.INFO),
+    )
+
+
+def load_config(argv: list = None):
+    """Read the config files and commandline and set up logging."""
+    config = read_config()
+    args = parse_args(config, argv)
+    setup_logging(args.ll)
+    return apply_args(config, args)
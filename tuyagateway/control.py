@@ -0,0 +1,91 @@
+"""ControlWorker, runs gateway config handling off the MQTT network loop."""
+import collections
+import threading
+import time
+from .configure import logger
+from .metrics import counter, gauge, histogram
+
+CONTROL_COALESCED = counter(
+    "control_coalesced_total",
+    "Control messages replaced by a newer message on the same topic.",
+    ("handler",),
+)
+CONTROL_QUEUE_DEPTH = gauge(
+    "control_queue_depth", "Discovery and config messages waiting to be handled."
+)
+CONTROL_HANDLER = histogram(
+    "control_handler_seconds",
+    "Duration of discovery and config handlers.",
+    labelnames=("handler",),
+)
+
+
+class ControlWorker(threading.Thread):
+    """Execute queued control calls (discovery, config) one by one.
+
+    Nothing is dropped. A config message only waits for the latest message
+    on its topic, so the queue holds at most one message per topic plus
+    the gateway's own calls.
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        """Initialize ControlWorker, maxsize pending calls log a warning."""
+        super().__init__(name="tuyagateway_control", daemon=True)
+        self.maxsize = maxsize
+        self._condition = threading.Condition()
+        # coalesce keys in order, the calls are in _pending
+        self._order = collections.deque()
+        self._pending = {}
+        self._stopping = False
+        self._warned = False
+        CONTROL_QUEUE_DEPTH.set_function(self.qsize)
+
+    def qsize(self) -> int:
+        """Return the number of pending calls."""
+        return len(self._order)
+
+    def _put(self, key, handler: callable, args: tuple):
+        with self._condition:
+            if key in self._pending:
+                CONTROL_COALESCED.labels(handler.__name__).inc()
+            else:
+                self._order.append(key)
+            self._pending[key] = (handler, args)
+            if self.maxsize and len(self._order) > self.maxsize and not self._warned:
+                self._warned = True
+                logger.warning("control queue over %s pending calls", self.maxsize)
+            self._condition.notify()
+
+    def submit(self, handler: callable, *args):
+        """Queue a call."""
+        self._put(object(), handler, args)
+
+    def submit_topic(self, topic: str, handler: callable, *args):
+        """Queue the handling of a message, replacing a pending one of the topic."""
+        self._put(("topic", topic), handler, args)
+
+    def run(self):
+        """Control worker main loop, stops once stopping and drained."""
+        while True:
+            with self._condition:
+                while not self._order and not self._stopping:
+                    self._condition.wait()
+                if not self._order:
+                    break
+                handler, args = self._pending.pop(self._order.popleft())
+                if not self._order:
+                    self._warned = False
+            started = time.monotonic()
+            try:
+                handler(*args)
+            except Exception:
+                logger.exception("control handler %s failed", handler.__name__)
+            CONTROL_HANDLER.labels(handler.__name__).observe(time.monotonic() - started)
+
+    def stop(self):
+        """Stop after the calls queued so far."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
@@ -21,18 +21,37 @@ def _validate_config(data_point: dict) -> bool:
 class DeviceDataPoint:
     """Tuya I/O datapoint processing."""
 
+    __slots__ = (
+        "_sanitized_input_data",
+        "_sanitized_output_data",
+        "_via",
+        "_changed",
+        "_type_value",
+        "_minimal",
+        "_maximal",
+        "_is_valid",
+    )
+
     def __init__(self, data_point: dict = None):
         """Initialize DeviceDataPoint."""
         self._sanitized_input_data = None
         self._sanitized_output_data = None
-        self._state_data = {"via": "tuya", "changed": False}
-        self._validated_config = {"type_value": "bool"}
-        self._is_valid = False
+        self._via = "tuya"
+        self._changed = False
         if data_point is None:
             data_point = {}
+        self.set_config(data_point)
 
+    def set_config(self, data_point: dict):
+        """Set the datapoint configuration, the value is kept."""
+        self._type_value = "bool"
+        self._minimal = None
+        self._maximal = None
+        self._is_valid = False
         if _validate_config(data_point):
-            self._validated_config = data_point
+            self._type_value = data_point["type_value"]
+            self._minimal = data_point.get("minimal")
+            self._maximal = data_point.get("maximal")
             self._is_valid = True
 
     def is_valid(self) -> bool:
@@ -41,11 +60,21 @@ class DeviceDataPoint:
 
     def get_state(self, key: str = None):
         """Get state of datapoint."""
+        if key == "via":
+            return self._via
+        if key == "changed":
+            return self._changed
         if key:
-            if key in self._state_data:
-                return self._state_data[key]
             return
-        return self._state_data
+        return {"via": self._via, "changed": self._changed}
+
+    def get_via(self) -> str:
+        """Return where the last value change came from."""
+        return self._via
+
+    def is_changed(self) -> bool:
+        """Return true if the value changed with the last status."""
+        return self._changed
 
     def get_device_payload(self):
         """Get the sanitized Tuya command message payload for data point."""
@@ -57,29 +86,32 @@ class DeviceDataPoint:
 
     def _sanitize_data_point(self, payload):
 
-        input_sanitize = self._validated_config
-        if input_sanitize["type_value"] == "bool":
+        type_value = self._type_value
+        if type_value == "bool":
             return bool(payload)
-        if input_sanitize["type_value"] == "str":
-            if len(payload) > input_sanitize["maximal"]:
-                return payload[: input_sanitize["maximal"]]
+        if type_value == "str":
+            if len(payload) > self._maximal:
+                return payload[: self._maximal]
             return payload
-        if input_sanitize["type_value"] == "int":
+        if type_value == "int":
             tmp_payload = int(payload)
-        elif input_sanitize["type_value"] == "float":
+        elif type_value == "float":
             tmp_payload = float(payload)
-        return max(
-            input_sanitize["minimal"], min(tmp_payload, input_sanitize["maximal"])
-        )
+        return max(self._minimal, min(tmp_payload, self._maximal))
+
+    def reset_changed(self):
+        """Clear the changed flag, before a new status is applied."""
+        self._changed = False
 
     def set_device_payload(self, data: dict, via: str):
         """Set the Tuya reply message payload for data point."""
 
         sanitized_data = self._sanitize_data_point(data)
-        self._state_data["changed"] = False
+        self._changed = False
 
         if sanitized_data != self._sanitized_output_data:
-            self._state_data = {"via": via, "changed": True}
+            self._via = via
+            self._changed = True
 
             self._sanitized_output_data = sanitized_data
             # overwrite old value for next compare
@@ -93,6 +125,17 @@ class DeviceDataPoint:
 class Device:
     """Tuya I/O processing."""
 
+    __slots__ = (
+        "_localkey",
+        "_protocol",
+        "_pref_status_cmd",
+        "_is_valid",
+        "_key",
+        "_ip_address",
+        "_device_config",
+        "_data_points",
+    )
+
     def __init__(self, device_dict: dict = None):
         """Initialize Device."""
         self._localkey = None
@@ -173,14 +216,50 @@ class Device:
 
         self._is_valid = True
 
+    def get_connection_config(self) -> dict:
+        """Return the parameters a Tuya connection depends on."""
+        return {
+            "deviceid": self._key,
+            "ip": self._ip_address,
+            "localkey": self._localkey,
+            "protocol": self._protocol,
+            "pref_status_cmd": self._pref_status_cmd,
+        }
+
+    def update_config(self, device_dict: dict):
+        """Apply datapoint changes of a config with the same connection."""
+        old_keys = {
+            data_point["key"]
+            for data_point in self._device_config.get("dps", [])
+            if _validate_config(data_point)
+        }
+        self._device_config = device_dict
+        new_keys = set()
+        for data_point in device_dict["dps"]:
+            if not _validate_config(data_point):
+                continue
+            new_keys.add(data_point["key"])
+            if data_point["key"] in self._data_points:
+                self._data_points[data_point["key"]].set_config(data_point)
+                continue
+            self._init_data_point(data_point["key"], data_point)
+
+        for dp_key in old_keys - new_keys:
+            self._data_points.pop(dp_key, None)
+
     def _set_pref_status_cmd(self, pref_status_cmd: int):
         if pref_status_cmd in [10, 13]:
             self._pref_status_cmd = pref_status_cmd
 
-    def get_device_payload(self) -> dict:
-        """Get the sanitized Tuya command message payload."""
+    def get_device_payload(self, indexes=None) -> dict:
+        """Get the sanitized Tuya command message payload.
+
+        With indexes only the payload of those datapoints.
+        """
         payload = {}
         for dp_idx, dp_item in self._data_points.items():
+            if indexes is not None and dp_idx not in indexes:
+                continue
             payload[str(dp_idx)] = dp_item.get_device_payload()
         return payload
 
@@ -189,6 +268,10 @@ class Device:
         if "dps" not in data:
             raise Exception("No data point values found.")
 
+        # changed flags only describe this status message
+        for item in self._data_points.values():
+            item.reset_changed()
+
         for (dp_idx, dp_data) in data["dps"].items():
             self._init_data_point(int(dp_idx))
             self._data_points[int(dp_idx)].set_device_payload(
@@ -209,19 +292,19 @@ class Device:
         return gw_payload
 
     def get_device_state(self) -> dict:
-        """Get the state of the device."""
-        device_state = {}
-        for (dp_idx, item,) in self._data_points.items():
-            device_state[dp_idx] = item.get_state()
-        return device_state
+        """Get the state of the device, datapoint -> (via, changed)."""
+        return {
+            dp_idx: (item.get_via(), item.is_changed())
+            for dp_idx, item in self._data_points.items()
+        }
 
     def get_tuyaface_config(self) -> dict:
         """Return dict for TuyaFace configuration."""
         attributes_dict = {"via": {}, "dps": {}, "changed": {}}
         for (dp_idx, item,) in self._data_points.items():
             attributes_dict["dps"][dp_idx] = item.get_gateway_payload()
-            attributes_dict["via"][dp_idx] = item.get_state("via")
-            attributes_dict["changed"][dp_idx] = item.get_state("changed")
+            attributes_dict["via"][dp_idx] = item.get_via()
+            attributes_dict["changed"][dp_idx] = item.is_changed()
 
         return {
             "protocol": self._protocol,
@@ -0,0 +1,449 @@
+"""Single event loop engine, runs all devices as coroutines."""
+import asyncio
+import concurrent.futures
+import threading
+import time
+from tuyaface import _generate_payload, _process_raw_reply, _set_properties
+from tuyaface.const import CMD_TYPE
+from . import codec
+from .configure import logger
+from .device import Device
+from .device_handler import DeviceHandler, observe_commands, observe_request
+from tuyagateway.transform.homeassistant import Transform
+
+HEART_BEAT_TIME = 7
+CONNECTION_STALE_TIME = 7
+RECONNECT_COOL_DOWN_TIME = 5
+REQUEST_TIMEOUT = 2
+TUYA_PORT = 6668
+FRAME_PREFIX = b"\x00\x00\x55\xaa"
+
+
+def _split_frames(buffer: bytes) -> tuple:
+    """Split complete Tuya frames off the receive buffer."""
+    frames = []
+    while True:
+        start = buffer.find(FRAME_PREFIX)
+        if start < 0:
+            return frames, b""
+        buffer = buffer[start:]
+        if len(buffer) < 16:
+            return frames, buffer
+        size = int.from_bytes(buffer[12:16], byteorder="big")
+        if len(buffer) < 16 + size:
+            return frames, buffer
+        frames.append(buffer[: 16 + size])
+        buffer = buffer[16 + size :]
+
+
+class AsyncTuyaClient:
+    """asyncio counterpart of tuyaface's TuyaClient."""
+
+    def __init__(
+        self,
+        device: dict,
+        on_status: callable = None,
+        on_connection: callable = None,
+        admit: callable = None,
+    ):
+        """Initialize the Tuya client.
+
+        admit(operation) returns an async context manager to hold while
+        connecting, see AdmissionController.async_slot.
+        """
+        _set_properties(device)
+        self.device = device
+        self.on_status = on_status
+        self.on_connection = on_connection
+        self._admit = admit
+        self.last_msg_rcv = time.time()
+        self._reader = None
+        self._writer = None
+        self._pending = {}
+        self._status_waiter = None
+        self._command_active = 0
+        self._stop = asyncio.Event()
+
+    async def _open_connection(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.device["ip"], TUYA_PORT), REQUEST_TIMEOUT
+        )
+
+    async def _connect(self):
+        if self._admit:
+            async with self._admit("connect"):
+                await self._open_connection()
+        else:
+            await self._open_connection()
+        self.last_msg_rcv = time.time()
+        logger.info("(%s) connected", self.device["ip"])
+        if self.on_connection:
+            self.on_connection(True)
+
+    def _disconnect(self):
+        if not self._writer:
+            return
+        self._writer.close()
+        self._reader = None
+        self._writer = None
+        for _, future in self._pending.values():
+            if not future.done():
+                future.set_result(None)
+        if self.on_connection:
+            self.on_connection(False)
+
+    async def _sleep(self, delay: float):
+        try:
+            await asyncio.wait_for(self._stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """Tuya client main loop."""
+        while not self._stop.is_set():
+            try:
+                await self._connect()
+            except (OSError, asyncio.TimeoutError):
+                logger.warning("(%s) exception when opening socket", self.device["ip"])
+                await self._sleep(RECONNECT_COOL_DOWN_TIME)
+                continue
+
+            heart_beat = asyncio.ensure_future(self._heart_beat())
+            try:
+                await self._read_loop()
+            except OSError:
+                logger.warning("(%s) exception when reading socket", self.device["ip"])
+            finally:
+                heart_beat.cancel()
+                self._disconnect()
+            await self._sleep(RECONNECT_COOL_DOWN_TIME)
+
+    async def stop_client(self):
+        """Close the connection and stop the client."""
+        self._stop.set()
+        self._disconnect()
+
+    async def _heart_beat(self):
+        while self._writer:
+            await asyncio.sleep(HEART_BEAT_TIME)
+            logger.debug("(%s) PING", self.device["ip"])
+            self._send(CMD_TYPE.HEART_BEAT)
+
+    async def _read_loop(self):
+        buffer = b""
+        while not self._stop.is_set():
+            read = asyncio.ensure_future(self._reader.read(4096))
+            stop = asyncio.ensure_future(self._stop.wait())
+            done, _ = await asyncio.wait(
+                [read, stop],
+                timeout=HEART_BEAT_TIME + CONNECTION_STALE_TIME,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            stop.cancel()
+            if read not in done:
+                read.cancel()
+                if not self._stop.is_set():
+                    logger.debug("(%s) connection stale", self.device["ip"])
+                return
+            data = read.result()
+            if not data:
+                return
+            frames, buffer = _split_frames(buffer + data)
+            for frame in frames:
+                for reply in _process_raw_reply(self.device, frame):
+                    self._on_reply(reply)
+
+    def _on_reply(self, reply: dict):
+        self.last_msg_rcv = time.time()
+        pending = self._pending.get(reply["seq"])
+        if pending and pending[0] == reply["cmd"] and not pending[1].done():
+            pending[1].set_result(reply)
+
+        if reply["cmd"] != CMD_TYPE.STATUS or not reply["data"]:
+            return
+        data = codec.loads(reply["data"])
+        if self._status_waiter and not self._status_waiter.done():
+            self._status_waiter.set_result(data)
+        if self.on_status:
+            self.on_status(data, "command" if self._command_active else "status")
+
+    def _send(self, command: int, data: dict = None) -> int:
+        request_cnt = self.device["tuyaface"]["sequence_nr"]
+        self.device["tuyaface"]["sequence_nr"] = request_cnt + 1
+        self._writer.write(_generate_payload(self.device, command, data, request_cnt))
+        return request_cnt
+
+    async def _request(self, command: int, data: dict = None) -> dict:
+        if not self._writer:
+            return None
+        future = asyncio.get_event_loop().create_future()
+        request_cnt = self._send(command, data)
+        self._pending[request_cnt] = (command, future)
+        try:
+            await self._writer.drain()
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            logger.warning("(%s) No reply to [%s]", self.device["ip"], command.name)
+            return None
+        finally:
+            self._pending.pop(request_cnt, None)
+
+    async def status(self) -> dict:
+        """Request status."""
+        if self.device["tuyaface"]["pref_status_cmd"] == CMD_TYPE.DP_QUERY:
+            reply = await self._request(CMD_TYPE.DP_QUERY)
+            if not reply or not reply["data"]:
+                return None
+            if reply["data"] != "json obj data unvalid":
+                return codec.loads(reply["data"])
+            # some devices (ie LSC Bulbs) only offer partial status with CONTROL_NEW
+            self.device["tuyaface"]["pref_status_cmd"] = CMD_TYPE.CONTROL_NEW
+
+        self._status_waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._request(CMD_TYPE.CONTROL_NEW)
+            return await asyncio.wait_for(self._status_waiter, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("(%s) No reply to status", self.device["ip"])
+            return None
+        finally:
+            self._status_waiter = None
+
+    async def set_status(self, value: dict) -> bool:
+        """Set status."""
+        if not isinstance(value, dict):
+            raise ValueError(f"Type {type(value)} not acceptable")
+
+        self._command_active += 1
+        try:
+            reply = await self._request(
+                CMD_TYPE.CONTROL, {str(k): v for k, v in value.items()}
+            )
+        finally:
+            self._command_active -= 1
+        if not reply or ("rc" in reply and reply["rc"] != 0):
+            return False
+        return True
+
+    async def set_state(self, value, idx: int = 1) -> bool:
+        """Set state."""
+        if not isinstance(value, (bool, float, int, str)):
+            raise ValueError(f"Type {type(value)} not acceptable")
+        return await self.set_status({idx: value})
+
+
+class AsyncEngine:
+    """Event loop thread shared by all AsyncDevices."""
+
+    def __init__(self):
+        """Initialize AsyncEngine."""
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run, name="tuyagateway_engine", daemon=True
+        )
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        """Start the event loop thread."""
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def submit(self, coro):
+        """Schedule coroutine on the event loop, return concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback: callable, *args):
+        """Call callback from another thread in the event loop."""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        """Stop the event loop thread."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+class AsyncDevice(DeviceHandler):
+    """Run device as coroutine on the AsyncEngine."""
+
+    def __init__(
+        self,
+        key: str,
+        device: Device,
+        transform: Transform,
+        parent,
+        engine: AsyncEngine,
+    ):
+        """Initialize AsyncDevice."""
+        super().__init__(key, device, transform, parent)
+        self.name = key
+        self._engine = engine
+        self._tuya_client = None
+        self._future = None
+        self.command_queue = None
+
+    def start(self):
+        """Schedule the device on the engine."""
+        self._future = self._engine.submit(self.run())
+
+    def is_alive(self) -> bool:
+        """Return true while the device coroutine runs."""
+        return self._future is not None and not self._future.done()
+
+    def join(self, timeout: float = None):
+        """Wait till the device coroutine has finished."""
+        if not self._future:
+            return
+        try:
+            self._future.result(timeout)
+        except concurrent.futures.CancelledError:
+            pass
+        except Exception:
+            logger.exception("(%s) device stopped with error", self.name)
+
+    def _request_stop(self):
+        if self._tuya_client is None:
+            # still waiting for config, nothing to shut down
+            self._future.cancel()
+            return
+        self._put((None, None))
+
+    def _put(self, item: tuple):
+        if self.command_queue:
+            self.command_queue.put_nowait(item)
+
+    def on_mqtt_message(self, message):
+        """MQTT message callback, executed in the MQTT client's context."""
+        if not self._is_command_message(message):
+            return
+        # We're in the MQTT client's context, hand over to the event loop
+        if self._add_command(message):
+            self._engine.call_soon(self._put, (self._flush_commands, ()))
+
+    def queue_depth(self) -> int:
+        """Return the number of queued commands."""
+        return self.command_queue.qsize() if self.command_queue else 0
+
+    def _admit(self, operation: str):
+        return self.parent.admission.async_slot(
+            self.key, self._device.get_ip_address(), operation
+        )
+
+    async def _flush_commands(self):
+        if self._command_window:
+            await asyncio.sleep(self._command_window)
+        device_payload, received = self._take_commands()
+        if not received:
+            return
+        single = self._single_datapoint(device_payload)
+        if single:
+            await self.set_state(*single)
+        elif device_payload:
+            await self.set_status(device_payload)
+        observe_commands(received)
+
+    def reconfigure(self, device_config: dict):
+        """Queue a datapoint reconfiguration of the running device."""
+        self._engine.call_soon(self._put, (self._reconfigure, (device_config,)))
+
+    def heartbeat(self):
+        """Queue a retained republish of the last known state."""
+        self._engine.call_soon(self._put, (self._publish_heartbeat, ()))
+
+    def poll(self, on_done: callable):
+        """Queue a status poll, on_done(key, success) is called when done."""
+        self._engine.call_soon(self._put, (self._poll, (on_done,)))
+
+    async def _poll(self, on_done: callable):
+        on_done(self.key, await self.request_status())
+
+    def on_tuya_connected(self, connected: bool):
+        """Tuya connection state updated."""
+        self._count_connection(connected)
+        self._set_availability(connected)
+        if connected:
+            self._put((self.request_status, ("mqtt",)))
+
+    async def request_status(self, via: str = "tuya") -> bool:
+        """Poll Tuya device for status, true if it replied."""
+        started = time.monotonic()
+        try:
+            async with self._admit("status"):
+                data = await self._tuya_client.status()
+        except Exception:
+            self._log_request_error("status")
+            return False
+        finally:
+            observe_request("status", started)
+        self._on_status_reply(data, via)
+        return bool(data)
+
+    async def set_state(self, dps_item: int, payload):
+        """Set state of Tuya device."""
+        started = time.monotonic()
+        try:
+            async with self._admit("set_state"):
+                result = await self._tuya_client.set_state(payload, dps_item)
+            if not result:
+                self._log_request_error("set_state")
+        except Exception:
+            self._log_request_error("set_state")
+        finally:
+            observe_request("set_state", started)
+
+    async def set_status(self, device_payload: dict):
+        """Set status of Tuya device."""
+        started = time.monotonic()
+        try:
+            async with self._admit("set_status"):
+                result = await self._tuya_client.set_status(device_payload)
+            if not result:
+                self._log_request_error("set_status")
+        except Exception:
+            self._log_request_error("set_status")
+        finally:
+            observe_request("set_status", started)
+
+    async def run(self):
+        """Device main coroutine."""
+        self.command_queue = asyncio.Queue()
+        started = time.monotonic()
+        while True:
+            try:
+                await self._transform.update_config(self._config_timeout)
+                break
+            except asyncio.TimeoutError:
+                self._log_config_waiting(started)
+        self._log_config_ready(started)
+
+        self.mqtt_connect()
+        self._publish_restored()
+        self._tuya_client = AsyncTuyaClient(
+            self._device.get_tuyaface_config(),
+            self.on_tuya_status,
+            self.on_tuya_connected,
+            self._admit,
+        )
+        client_task = asyncio.ensure_future(self._tuya_client.run())
+        self._running = True
+
+        while True:
+            command, args = await self.command_queue.get()
+            if command is None:
+                break
+            result = command(*args)
+            if asyncio.iscoroutine(result):
+                await result
+
+        await self._tuya_client.stop_client()
+        await client_task
+
+    def stop_entity(self):
+        """Shut down the TuyaClient and the device coroutine."""
+        logger.info("Stopping AsyncDevice %s", self.name)
+        self._engine.call_soon(self._request_stop)
+        self.join()
+        self._set_availability(False)
+        self._mqtt.unregister(self.key)
@@ -0,0 +1,321 @@
+"""DeviceHandler, the engine independent part of a device worker."""
+import abc
+import threading
+import time
+from . import codec
+from .configure import logger
+from .device import Device
+from .metrics import counter, gauge, histogram
+from tuyagateway.transform.homeassistant import Transform
+
+COMMAND_LATENCY = histogram(
+    "command_latency_seconds",
+    "Time from MQTT command received till the device acknowledged it.",
+)
+CONFIG_WAIT = histogram(
+    "config_wait_seconds",
+    "Time a device waited for its Home Assistant and component config.",
+    (0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+TUYA_REQUEST = histogram(
+    "tuya_request_seconds",
+    "Duration of Tuya requests (status, set_status, set_state).",
+    labelnames=("request",),
+)
+TUYA_REQUEST_ERRORS = counter(
+    "tuya_request_errors_total", "Failed Tuya requests.", ("device", "request")
+)
+TUYA_CONNECTION = counter(
+    "tuya_connection_changes_total",
+    "Tuya connects and disconnects per device.",
+    ("device", "state"),
+)
+TUYA_STATUS = counter(
+    "tuya_status_total", "Status messages received per device.", ("device",)
+)
+COMMANDS_COALESCED = counter(
+    "commands_coalesced_total",
+    "Command messages merged into an earlier set_status per device.",
+    ("device",),
+)
+COMMAND_BATCH = histogram(
+    "command_batch_size",
+    "Command messages sent in one set_status.",
+    (1, 2, 5, 10, 20, 50, 100),
+)
+QUEUE_DEPTH = gauge(
+    "device_queue_depth", "Commands waiting in the device queue.", ("device",)
+)
+
+
+def observe_commands(received: list):
+    """Record the latency of the commands received at the monotonic times."""
+    now = time.monotonic()
+    for item in received:
+        COMMAND_LATENCY.observe(now - item)
+
+
+def observe_request(request_type: str, started: float):
+    """Record the duration of a Tuya request started at monotonic time started."""
+    TUYA_REQUEST.labels(request_type).observe(time.monotonic() - started)
+
+
+class DeviceHandler(abc.ABC):
+    """Glue between the MQTT topics, the transform and the device data.
+
+    The engines (thread, asyncio) add the Tuya I/O and the command loop.
+    """
+
+    def __init__(self, key: str, device: Device, transform: Transform, parent):
+        """Initialize DeviceHandler."""
+        self.key = key
+
+        self._device = device
+        self.parent = parent
+        self.config = self.parent.config
+
+        self._transform = transform
+
+        self._availability = False
+        self._mqtt = self.parent.mqtt
+        self._config_timeout = float(self.config["General"].get("config_timeout", 60))
+        # publish_mode "changed" only publishes datapoints that changed value
+        self._changed_only = self.config["General"].get("publish_mode") == "changed"
+        self._full_refresh = float(
+            self.config["General"].get("full_refresh_interval", 0)
+        )
+        self._last_full_publish = None
+        self._has_status = False
+        self._restored_pending = False
+        self._running = False
+        # commands arriving within command_window are sent as one set_status
+        self._command_window = float(self.config["General"].get("command_window", 0))
+        self._pending_commands = []
+        # command_mode "delta" only sends the datapoints set by the commands
+        self._delta_commands = self.config["General"].get("command_mode") == "delta"
+        self._commands_lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        """Return true once the config arrived and the device is started."""
+        return self._running
+
+    def is_available(self) -> bool:
+        """Return true while the Tuya device is connected."""
+        return self._availability
+
+    @abc.abstractmethod
+    def reconfigure(self, device_config: dict):
+        """Queue a datapoint reconfiguration of the running device."""
+
+    def _reconfigure(self, device_config: dict):
+        self._device.update_config(device_config)
+        self._transform.update_device_config(device_config)
+        self.parent.registry.add(self._device, self._transform)
+        self.mqtt_connect()
+
+    def mqtt_connect(self):
+        """Register the device on the shared MQTT connection pool."""
+        # listen only to command topics we can process
+        self._mqtt.register(
+            self.key,
+            self._transform.get_subscribe_topics(),
+            self.on_mqtt_message,
+            self.on_mqtt_connect,
+        )
+
+    @abc.abstractmethod
+    def on_mqtt_message(self, message):
+        """MQTT message callback, executed in the MQTT client's context."""
+
+    @abc.abstractmethod
+    def queue_depth(self) -> int:
+        """Return the number of queued commands."""
+
+    def _log_config_waiting(self, started: float):
+        logger.warning(
+            "(%s) still waiting for config after %.0fs",
+            self._device.get_ip_address(),
+            time.monotonic() - started,
+        )
+
+    def _log_config_ready(self, started: float):
+        waited = time.monotonic() - started
+        CONFIG_WAIT.observe(waited)
+        logger.info(
+            "(%s) config ready after %.3fs", self._device.get_ip_address(), waited
+        )
+
+    def _is_command_message(self, message) -> bool:
+
+        if message.topic[-7:] != "command":
+            return False
+
+        logger.debug(
+            "(%s) topic %s retained %s message received %s",
+            self._device.get_ip_address(),
+            message.topic,
+            message.retain,
+            message.payload,
+        )
+        return True
+
+    def _add_command(self, message) -> bool:
+        """Add a command message, true if a flush needs to be queued."""
+        with self._commands_lock:
+            self._pending_commands.append((message, time.monotonic()))
+            return len(self._pending_commands) == 1
+
+    def _take_commands(self) -> tuple:
+        """Merge the pending commands, return the device payload and receive times.
+
+        Commands are applied in arrival order, so the last write per
+        datapoint wins.
+        """
+        with self._commands_lock:
+            commands, self._pending_commands = self._pending_commands, []
+        if not commands:
+            return None, []
+        COMMAND_BATCH.observe(len(commands))
+        if len(commands) > 1:
+            COMMANDS_COALESCED.labels(self.key).inc(len(commands) - 1)
+        received = [item[1] for item in commands]
+        indexes = set()
+        for message, _ in commands:
+            indexes.update(self._apply_command(message))
+        if not self._delta_commands:
+            gw_payload = self._transform.get_gateway_payload()
+            self._device.set_gateway_payload(gw_payload)
+            return self._device.get_device_payload(), received
+
+        # unknown command values map to None, leave those datapoints alone
+        gw_payload = {
+            idx: value
+            for idx, value in self._transform.get_gateway_payload(indexes).items()
+            if value is not None
+        }
+        self._device.set_gateway_payload(gw_payload)
+        return self._device.get_device_payload(set(gw_payload)), received
+
+    def _apply_command(self, message) -> list:
+        """Pass a command message on to the transform, return the datapoints set."""
+        topic_parts = message.topic.split("/")
+        try:
+            payload = codec.loads(message.payload)
+        except Exception:
+            payload = message.payload
+
+        return self._transform.set_input_payload(topic_parts, payload)
+
+    def _single_datapoint(self, device_payload: dict) -> tuple:
+        """Return (index, value) if a delta payload sets one datapoint, else None."""
+        if not self._delta_commands or len(device_payload) != 1:
+            return None
+        ((idx, value),) = device_payload.items()
+        return int(idx), value
+
+    def on_mqtt_connect(self):
+        """MQTT (re)connect of the shared connection, restore availability."""
+        # the will of the shared connection marks the gateway offline, the
+        # device availability is restored here
+        self._set_availability(self._availability, force=True)
+        if self._restored_pending:
+            self._restored_pending = False
+            self._publish(self._transform.get_publish_content())
+
+    def _set_availability(self, availability: bool, force: bool = False):
+
+        if availability == self._availability and not force:
+            return
+
+        self._availability = availability
+        logger.debug("->publish %s/availability", self._device.get_ip_address())
+
+        pub_content = self._transform.get_publish_availability(availability)
+        for item in pub_content:
+            self._mqtt.publish(
+                self.key, item["topic"], item["payload"], retain=True,
+            )
+
+    def _set_device_status(self, data: dict, via: str):
+        """Pass a Tuya status reply on to the device and transform."""
+        self._device.set_device_payload(data, via=via)
+        device_state = self._device.get_device_state()
+        self._transform.set_device_state(device_state)
+
+        self._transform.set_gateway_payload(self._device.get_gateway_payload())
+        self._has_status = True
+        if any(changed for _, changed in device_state.values()):
+            self.parent.poller.changed(self.key)
+
+    def _publish(self, pub_content, retain: bool = False):
+        for item in pub_content:
+            logger.debug("->publish %s %s", item["topic"], item["payload"])
+            self._mqtt.publish(self.key, item["topic"], item["payload"], retain=retain)
+
+    def _only_changed(self) -> bool:
+        """Return true if this status publishes changed datapoints only."""
+        if not self._changed_only:
+            return False
+        now = time.monotonic()
+        # first status publishes everything, then every full_refresh_interval
+        if self._last_full_publish is None or (
+            self._full_refresh and now - self._last_full_publish >= self._full_refresh
+        ):
+            self._last_full_publish = now
+            return False
+        return True
+
+    def on_tuya_status(self, data: dict, status_from: str):
+        """Tuya status message callback."""
+        TUYA_STATUS.labels(self.key).inc()
+        via = "tuya"
+        if status_from == "command":
+            via = "mqtt"
+        self._set_device_status(data, via)
+        self._publish(self._transform.get_publish_content(self._only_changed()))
+
+    def _on_status_reply(self, data: dict, via: str):
+        """Publish the reply of a status request."""
+        if not data:
+            return
+        self._set_device_status(data, via)
+        self._publish(self._transform.get_output_payload(self._only_changed()))
+
+    @abc.abstractmethod
+    def heartbeat(self):
+        """Queue a retained republish of the last known state."""
+
+    @abc.abstractmethod
+    def poll(self, on_done: callable):
+        """Queue a status poll, on_done(key, success) is called when done."""
+
+    def _publish_restored(self):
+        """Publish the last known state from the snapshot, if any."""
+        data = self.parent.pop_restored_status(self.key)
+        if not data or self._has_status:
+            return
+        self._set_device_status(data, "tuya")
+        if not self._mqtt.connection_for(self.key).connected:
+            # published by on_mqtt_connect
+            self._restored_pending = True
+            return
+        self._publish(self._transform.get_publish_content())
+
+    def _publish_heartbeat(self):
+        if not self._has_status:
+            return
+        self._publish(self._transform.get_publish_content(), retain=True)
+
+    def _count_connection(self, connected: bool):
+        TUYA_CONNECTION.labels(
+            self.key, "connected" if connected else "disconnected"
+        ).inc()
+
+    def _log_request_error(self, request_type: str):
+        TUYA_REQUEST_ERRORS.labels(self.key, request_type).inc()
+        logger.error(
+            "(%s) %s request failed",
+            self._device.get_ip_address(),
+            request_type,
+            exc_info=True,
+        )
@@ -1,230 +1,228 @@
 """DeviceThread."""
 import time
-import paho.mqtt.client as mqtt
-import json
 import queue
 import threading
 import asyncio
+import contextlib
+import socket
 from .configure import logger
 from .device import Device
+from .device_handler import DeviceHandler, observe_commands, observe_request
 from tuyagateway.transform.homeassistant import Transform
 from tuyaface.tuyaclient import TuyaClient
 
 
-def connack_string(state):
-    """Return mqtt connection string."""
-    states = [
-        "Connection successful",
-        "Connection refused - incorrect protocol version",
-        "Connection refused - invalid client identifier",
-        "Connection refused - server unavailable",
-        "Connection refused - bad username or password",
-        "Connection refused - not authorised",
-    ]
-    return states[state]
+class AdmittedTuyaClient(TuyaClient):
+    """TuyaClient that asks for an admission slot before connecting."""
 
+    def __init__(self, device: dict, on_status, on_connection, admit: callable):
+        """Initialize AdmittedTuyaClient."""
+        super().__init__(device, on_status, on_connection)
+        self._admit = admit
 
-class DeviceThread(threading.Thread):
-    """Run thread for device."""
+    def _connect(self):
+        if self.device["tuyaface"]["connection"]:
+            super()._connect()
+            return
+        with self._admit("connect", self.stop) as admitted:
+            if not admitted:
+                raise socket.error("stopped while waiting to connect")
+            super()._connect()
 
-    delay = 0.1
+
+class DeviceThread(DeviceHandler, threading.Thread):
+    """Run thread for device."""
 
     def __init__(self, key: str, device: Device, transform: Transform, parent):
         """Initialize DeviceThread."""
-        super().__init__()
-        self.key = key
+        threading.Thread.__init__(self)
+        DeviceHandler.__init__(self, key, device, transform, parent)
         self.name = key  # Set thread name to key
 
-        self._device = device
-        self.parent = parent
-        self.config = self.parent.config
-
-        self._transform = transform
-
-        self._availability = False
         self._tuya_client = None
+        self._config_loop = None
+        self._config_task = None
         self.stop = threading.Event()
-        self._mqtt_client = mqtt.Client()
+        self._in_request = threading.Event()
 
         self.command_queue = queue.Queue()
 
-    def mqtt_connect(self):
-        """Create MQTT client."""
-        self._mqtt_client.enable_logger()
-        if self.config["MQTT"]["user"] and self.config["MQTT"]["pass"]:
-            self._mqtt_client.username_pw_set(
-                self.config["MQTT"]["user"], self.config["MQTT"]["pass"]
-            )
-
-        # BUG: only last item is set, does it take a list?
-        # problem only 1 per connection
-        for item in self._transform.get_publish_availability(False):
-            self._mqtt_client.will_set(
-                item["topic"], item["payload"], retain=True,
-            )
-
-        self._mqtt_client.connect_async(
-            self.config["MQTT"].get("host", "127.0.0.1"),
-            int(self.config["MQTT"].get("port", 1883)),
-            60,
+    @contextlib.contextmanager
+    def _request_slot(self, operation: str):
+        """Hold an admission slot for a request of the device."""
+        with self.parent.admission.slot(
+            self.key, self._device.get_ip_address(), operation, self.stop
+        ) as admitted:
+            self._in_request.set()
+            try:
+                yield admitted
+            finally:
+                self._in_request.clear()
+
+    def _admit(self, operation: str, stop: threading.Event):
+        if self._in_request.is_set():
+            # TuyaClient reconnects within a request that holds a slot already
+            return contextlib.ExitStack()
+        return self.parent.admission.slot(
+            self.key, self._device.get_ip_address(), operation, stop
         )
-        self._mqtt_client.on_connect = self.on_mqtt_connect
-        self._mqtt_client.on_message = self.on_mqtt_message
-        self._mqtt_client.loop_start()
 
-    def on_mqtt_message(self, client, userdata, message):
+    def on_mqtt_message(self, message):
         """MQTT message callback, executed in the MQTT client's context."""
-        if message.topic[-7:] != "command":
+        if not self._is_command_message(message):
             return
 
-        logger.debug(
-            "(%s) topic %s retained %s message received %s",
-            self._device.get_ip_address(),
-            message.topic,
-            message.retain,
-            str(message.payload.decode("utf-8")),
-        )
-
         # We're in the MQTT client's context, queue a call to handle the message
-        self.command_queue.put((self._handle_mqtt_message, (message,)))
-
-    def _handle_mqtt_message(self, message):
-
-        topic_parts = message.topic.split("/")
-        try:
-            payload = json.loads(message.payload)
-        except Exception:
-            payload = message.payload
-
-        self._transform.set_input_payload(topic_parts, payload)
-        gw_payload = self._transform.get_gateway_payload()
-        # print(gw_payload)
-
-        self._device.set_gateway_payload(gw_payload)
-        device_payload = self._device.get_device_payload()
-
-        self.set_status(device_payload)
-
-    def on_mqtt_connect(self, client, userdata, flags, return_code):
-        """MQTT connect callback, executed in the MQTT client's context."""
-        logger.info(
-            "MQTT Connection state: %s for %s",
-            connack_string(return_code),
-            self._device.get_ip_address(),
-        )
-        # listen only to command topics we can process
-        topics = self._transform.get_subscribe_topics()
-        client.subscribe(topics)
+        if self._add_command(message):
+            self.command_queue.put((self._flush_commands, ()))
+
+    def queue_depth(self) -> int:
+        """Return the number of queued commands."""
+        return self.command_queue.qsize()
+
+    def _flush_commands(self):
+        if self._command_window:
+            self.stop.wait(self._command_window)
+        device_payload, received = self._take_commands()
+        if not received:
+            return
+        single = self._single_datapoint(device_payload)
+        if single:
+            self.set_state(*single)
+        elif device_payload:
+            self.set_status(device_payload)
+        observe_commands(received)
 
-    def _set_availability(self, availability: bool):
+    def reconfigure(self, device_config: dict):
+        """Queue a datapoint reconfiguration of the running device."""
+        self.command_queue.put((self._reconfigure, (device_config,)))
 
-        if availability == self._availability:
-            return
+    def heartbeat(self):
+        """Queue a retained republish of the last known state."""
+        self.command_queue.put((self._publish_heartbeat, ()))
 
-        self._availability = availability
-        logger.debug("->publish %s/availability", self._device.get_ip_address())
+    def poll(self, on_done: callable):
+        """Queue a status poll, on_done(key, success) is called when done."""
+        self.command_queue.put((self._poll, (on_done,)))
 
-        pub_content = self._transform.get_publish_availability(availability)
-        for item in pub_content:
-            # print(item["topic"], item["payload"])
-            self._mqtt_client.publish(
-                item["topic"], item["payload"], retain=True,
-            )
+    def _poll(self, on_done: callable):
+        on_done(self.key, self.request_status())
 
     def on_tuya_connected(self, connected: bool):
         """Tuya connection state updated."""
+        self._count_connection(connected)
         self._set_availability(connected)
         # We're in TuyaClient's context, queue a call to tuyaclient.status
         self.command_queue.put((self.request_status, ("mqtt",)))
 
-    def on_tuya_status(self, data: dict, status_from: str):
-        """Tuya status message callback."""
-        via = "tuya"
-        if status_from == "command":
-            via = "mqtt"
-        self._device.set_device_payload(data, via=via)
-        device_state = self._device.get_device_state()
-        self._transform.set_device_state(device_state)
-
-        self._transform.set_gateway_payload(self._device.get_gateway_payload())
-        for item in self._transform.get_publish_content():
-            # get_output_payload():
-            print(item["topic"], item["payload"])
-            self._mqtt_client.publish(item["topic"], item["payload"])
-
-    def request_status(self, via: str = "tuya"):
-        """Poll Tuya device for status."""
+    def request_status(self, via: str = "tuya") -> bool:
+        """Poll Tuya device for status, true if it replied."""
+        started = time.monotonic()
         try:
-            data = self._tuya_client.status()
-            if not data:
-                return
-            self._device.set_device_payload(data, via=via)
-            device_state = self._device.get_device_state()
-            self._transform.set_device_state(device_state)
-
-            self._transform.set_gateway_payload(self._device.get_gateway_payload())
-            for item in self._transform.get_output_payload():
-                self._mqtt_client.publish(item["topic"], item["payload"])
+            with self._request_slot("status") as admitted:
+                if not admitted:
+                    return False
+                data = self._tuya_client.status()
         except Exception:
-            logger.exception("(%s) status request error", self._device.get_ip_address())
-
-    def _log_request_error(self, request_type: str):
-        logger.error(
-            "(%s) %s request failed",
-            self._device.get_ip_address(),
-            request_type,
-            exc_info=True,
-        )
+            self._log_request_error("status")
+            return False
+        finally:
+            observe_request("status", started)
+        self._on_status_reply(data, via)
+        return bool(data)
 
     def set_state(self, dps_item: int, payload):
         """Set state of Tuya device."""
+        started = time.monotonic()
         try:
-            result = self._tuya_client.set_state(payload, dps_item)
+            with self._request_slot("set_state") as admitted:
+                if not admitted:
+                    return
+                result = self._tuya_client.set_state(payload, dps_item)
             if not result:
                 self._log_request_error("set_state")
         except Exception:
             self._log_request_error("set_state")
+        finally:
+            observe_request("set_state", started)
 
     def set_status(self, device_payload: dict):
         """Set status of Tuya device."""
+        started = time.monotonic()
         try:
-            # print(device_payload)
-            result = self._tuya_client.set_status(device_payload)
+            with self._request_slot("set_status") as admitted:
+                if not admitted:
+                    return
+                result = self._tuya_client.set_status(device_payload)
             if not result:
                 self._log_request_error("set_status")
         except Exception:
             self._log_request_error("set_status")
+        finally:
+            observe_request("set_status", started)
 
-    def run(self):
-        """Tuya MQTTEntity main loop."""
-
+    def _wait_for_config(self) -> bool:
+        """Wait till all config arrived, false if stopped while waiting."""
+        started = time.monotonic()
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        self._config_loop = loop
         try:
-            loop.run_until_complete(self._transform.update_config())
+            while not self.stop.is_set():
+                self._config_task = loop.create_task(
+                    self._transform.update_config(self._config_timeout)
+                )
+                try:
+                    loop.run_until_complete(self._config_task)
+                    self._log_config_ready(started)
+                    return True
+                except asyncio.TimeoutError:
+                    self._log_config_waiting(started)
+                except asyncio.CancelledError:
+                    break
         finally:
+            self._config_loop = None
             loop.close()
+        return False
+
+    def run(self):
+        """Tuya MQTTEntity main loop."""
+
+        if not self._wait_for_config():
+            return
 
         self.mqtt_connect()
-        self._tuya_client = TuyaClient(
+        self._publish_restored()
+        self._tuya_client = AdmittedTuyaClient(
             self._device.get_tuyaface_config(),
             self.on_tuya_status,
             self.on_tuya_connected,
+            self._admit,
         )
         self._tuya_client.start()
+        self._running = True
 
+        # block till there is work, a (None, None) sentinel stops the loop
         while not self.stop.is_set():
-
-            while not self.command_queue.empty():
-                command, args = self.command_queue.get()
-                command(*args)
-
-            time.sleep(self.delay)
+            command, args = self.command_queue.get()
+            if command is None:
+                break
+            command(*args)
 
     def stop_entity(self):
         """Shut down MQTT client, TuyaClient and worker thread."""
         logger.info("Stopping DeviceThread %s", self.name)
-        self._tuya_client.stop_client()
-        self._mqtt_client.loop_stop()
         self.stop.set()
+        config_loop, config_task = self._config_loop, self._config_task
+        if config_loop and config_task:
+            try:
+                config_loop.call_soon_threadsafe(config_task.cancel)
+            except RuntimeError:
+                # loop closed in the meantime
+                pass
+        if self._tuya_client:
+            self._tuya_client.stop_client()
+        self._set_availability(False)
+        self._mqtt.unregister(self.key)
+        self.command_queue.put((None, None))
         self.join()
@@ -0,0 +1,89 @@
+"""MetricsExporter, serves the metrics over HTTP and/or publishes them to MQTT."""
+import http.server
+import socketserver
+import threading
+from . import codec, metrics
+from .configure import logger
+
+
+class _MetricsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve the metrics in the Prometheus text format."""
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):  # pylint: disable=arguments-differ
+        logger.debug("metrics %s", fmt % args)
+
+
+class MetricsExporter:
+    """Expose the metrics registry as configured in the [Metrics] section.
+
+    Metric collection is only enabled when an HTTP port or an MQTT stats
+    topic is configured.
+    """
+
+    def __init__(self, config: dict, mqtt=None):
+        """Initialize MetricsExporter."""
+        section = config["Metrics"] if "Metrics" in config else {}
+        self._host = section.get("http_host", "127.0.0.1")
+        self._port = int(section.get("http_port", 0) or 0)
+        self._topic = section.get("mqtt_topic", "")
+        self._interval = float(section.get("interval", 60))
+        self._mqtt = mqtt
+        self._server = None
+        self._publisher = None
+        self._stop = threading.Event()
+        self.enabled = bool(self._port or self._topic)
+
+    def start(self):
+        """Enable collection, start the HTTP server and the MQTT publisher."""
+        if not self.enabled:
+            return
+        metrics.enable()
+        if self._port:
+            self._server = _MetricsHTTPServer((self._host, self._port), _MetricsHandler)
+            threading.Thread(
+                target=self._server.serve_forever,
+                name="tuyagateway_metrics_http",
+                daemon=True,
+            ).start()
+            logger.info(
+                "metrics served on http://%s:%s/metrics", self._host, self._port
+            )
+        if self._topic and self._mqtt:
+            self._publisher = threading.Thread(
+                target=self._publish_loop, name="tuyagateway_metrics", daemon=True
+            )
+            self._publisher.start()
+
+    def publish(self):
+        """Publish a metrics snapshot to the MQTT stats topic."""
+        self._mqtt.publish_gateway(self._topic, codec.dumps(metrics.snapshot()))
+
+    def _publish_loop(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.publish()
+            except Exception:
+                logger.exception("metrics publish failed")
+
+    def stop(self):
+        """Stop the HTTP server and the MQTT publisher."""
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._publisher:
+            self._publisher.join()
@@ -0,0 +1,512 @@
+"""TuyaMQTT."""
+import threading
+import time
+import paho.mqtt.client as mqtt
+from .configure import logger
+from . import codec
+from .admission import AdmissionController
+from .cluster import ClusterMembership
+from .control import ControlWorker
+from .device import Device
+from .device_handler import QUEUE_DEPTH
+from .exporter import MetricsExporter
+from .metrics import gauge
+from .poller import PollScheduler
+from .mqtt_manager import MQTTManager
+from .readiness import ConfigReadiness
+from .registry import DeviceRegistry
+from .router import TopicRouter
+from .snapshot import Snapshot
+from .startup import StartupPipeline
+from tuyagateway.transform.homeassistant import Transform
+
+GATEWAY_TOPICS = [
+    ("tuyagateway/discovery/+", 0),
+    ("tuyagateway/config/homeassistant/+", 0),
+]
+# Home Assistant config of a device datapoint, any component
+HA_CONFIG_TOPIC = "homeassistant/+/{}_{}/config"
+
+
+def ha_config_topics(key: str, discover_dict: dict) -> list:
+    """Return the Home Assistant config subscriptions of the device datapoints."""
+    return [
+        (HA_CONFIG_TOPIC.format(key, data_point["key"]), 0)
+        for data_point in discover_dict.get("dps", [])
+    ]
+
+
+DEVICES = gauge("devices", "Devices by state.", ("state",))
+
+
+# TODO: why is this a class? declass
+class TuyaMQTT:
+    """Manages a set of TuyaMQTTEntities."""
+
+    delay = 0.1
+    config = []
+    worker_threads = {}
+    _ha_config = {}
+    _ha_component = {}
+
+    def __init__(self, config, subscribe: bool = True):
+        """Initialize DeviceThread.
+
+        Without subscribe the gateway topics aren't subscribed, discovery and
+        config are passed to on_mqtt_message by the caller (a supervisor).
+        """
+        self.config = config
+        self._subscribe = subscribe
+        codec.use(config["General"].get("json_codec", "auto"))
+        self.worker_threads = {}
+        self._ha_config = {}
+        self._ha_component = {}
+        self.mqtt_client = mqtt.Client()
+        # all devices publish/subscribe through the shared connection pool
+        self.mqtt = MQTTManager(config, self.mqtt_client)
+        self._config_ready = ConfigReadiness()
+        self.registry = DeviceRegistry()
+        # discovery and config are handled off the MQTT network loop
+        self.control = ControlWorker(
+            int(config["General"].get("control_queue_size", 1000))
+        )
+        self.engine = None
+        if config["General"].get("engine", "thread") == "asyncio":
+            # pylint: disable=import-outside-toplevel
+            from .device_async import AsyncEngine
+
+            self.engine = AsyncEngine()
+        self.exporter = MetricsExporter(config, self.mqtt)
+        self.poller = PollScheduler(config, self._poll_device)
+        # limits concurrent Tuya connects and requests over all devices
+        self.admission = AdmissionController(config)
+        self.startup = StartupPipeline(config, self.control, self._start_device_thread)
+        self._snapshot_file = config["General"].get("snapshot_file", "")
+        # device id -> Tuya status from the snapshot, published on start
+        self._restored_status = {}
+        # devices from the snapshot not confirmed by a discovery message yet
+        self._unconfirmed = set()
+        self.router = TopicRouter()
+        self.router.add("tuyagateway/discovery/+", self._handle_discover_message)
+        self.router.add(
+            "tuyagateway/config/homeassistant/+", self._handle_ha_component_message
+        )
+        self.router.add("homeassistant/+/+/config", self._handle_ha_config_message)
+        # handlers that don't block, they run on the MQTT network loop
+        self.inline_router = TopicRouter()
+        self.cluster = ClusterMembership(
+            config,
+            self.mqtt,
+            self.registry.keys,
+            lambda key: self.control.submit(self._cluster_start, key),
+            lambda key: self.control.submit(self._cluster_stop, key),
+        )
+        QUEUE_DEPTH.set_function(self._queue_depths)
+        DEVICES.set_function(self._device_states)
+
+    def _queue_depths(self) -> dict:
+        return {
+            (key,): worker.queue_depth()
+            for key, worker in list(self.worker_threads.items())
+        }
+
+    def _device_states(self) -> dict:
+        workers = list(self.worker_threads.values())
+        running = sum(1 for worker in workers if worker.is_running())
+        online = sum(1 for worker in workers if worker.is_available())
+        return {
+            ("running",): running,
+            ("waiting_for_config",): len(workers) - running,
+            ("online",): online,
+        }
+
+    def _poll_device(self, key: str, on_done: callable) -> bool:
+        worker = self.worker_threads.get(key)
+        if not worker or not worker.is_running():
+            return False
+        worker.poll(on_done)
+        return True
+
+    def _load_snapshot(self):
+        """Start the devices of the snapshot with their config and state."""
+        snapshot = Snapshot(self._snapshot_file)
+        if not snapshot.load():
+            return
+        for name, component in snapshot.components.items():
+            self._ha_component[name] = component
+            self._config_ready.set_ready(("component", name))
+        for key, configs in snapshot.homeassistant.items():
+            for idx, ha_dict in configs.items():
+                self._ha_config.setdefault(key, {})[idx] = ha_dict
+                self._config_ready.set_ready(("homeassistant", key, idx))
+        for key, discover_dict in snapshot.discovery.items():
+            device = Device(discover_dict)
+            if not device.is_valid():
+                continue
+            if snapshot.state.get(key):
+                self._restored_status[key] = {"dps": snapshot.state[key]}
+            self._unconfirmed.add(key)
+            self._subscribe_config(key, discover_dict)
+            self._add_device(device, Transform(self, discover_dict))
+        logger.info(
+            "restored %s devices from snapshot %s",
+            len(self._unconfirmed),
+            self._snapshot_file,
+        )
+        reconcile = threading.Timer(
+            float(self.config["General"].get("snapshot_reconcile", 120)),
+            self.control.submit,
+            (self._drop_unconfirmed,),
+        )
+        reconcile.daemon = True
+        reconcile.start()
+
+    def _drop_unconfirmed(self):
+        """Stop the snapshot devices the broker didn't confirm."""
+        for key in list(self._unconfirmed):
+            logger.info("%s not discovered again, removed", key)
+            self.remove_device(key)
+        self._unconfirmed.clear()
+
+    def remove_device(self, key: str):
+        """Stop the device and forget its config."""
+        self._stop_device(key)
+        self.registry.remove(key)
+        self.mqtt.set_config_topics(key, [])
+        self._restored_status.pop(key, None)
+
+    def _subscribe_config(self, key: str, discover_dict: dict):
+        """Subscribe the Home Assistant config topics of the device datapoints."""
+        if not self._subscribe:
+            return
+        self.mqtt.set_config_topics(key, ha_config_topics(key, discover_dict))
+
+    def pop_restored_status(self, key: str) -> dict:
+        """Return the snapshot status of the device once, None if there is none."""
+        return self._restored_status.pop(key, None)
+
+    def _save_snapshot(self):
+        """Write config and last known state of all devices to the snapshot."""
+        snapshot = Snapshot(self._snapshot_file)
+        snapshot.components = dict(self._ha_component)
+        snapshot.homeassistant = {
+            key: dict(configs) for key, configs in list(self._ha_config.items())
+        }
+        for key in self.registry.keys():
+            device = self.registry.get_device(key)
+            if device is None:
+                continue
+            snapshot.discovery[key] = device.get_config()
+            try:
+                payload = device.get_gateway_payload()
+            except RuntimeError:
+                # datapoints changed by a reconfigure meanwhile
+                continue
+            snapshot.state[key] = {
+                str(idx): value for idx, value in payload.items() if value is not None
+            }
+        try:
+            snapshot.save()
+        except OSError:
+            logger.exception("writing snapshot %s failed", self._snapshot_file)
+
+    def mqtt_connect(self):
+        """Connect the shared MQTT connection pool."""
+        self.control.start()
+        self.exporter.start()
+        if self.poller.enabled:
+            self.poller.start()
+        if self.startup.enabled:
+            self.startup.start()
+        if self._snapshot_file:
+            self._load_snapshot()
+        gateway_topics = GATEWAY_TOPICS if self._subscribe else []
+        if self.cluster.enabled:
+            gateway_topics = gateway_topics + self.cluster.topics()
+            self.inline_router.add(
+                f"{self.cluster.topic}/nodes/+", self.cluster.on_node_message
+            )
+            self.inline_router.add(
+                f"{self.cluster.topic}/leases/+", self.cluster.on_lease_message
+            )
+            self.cluster.set_will()
+            self.cluster.start()
+        self.mqtt.set_gateway_handler(gateway_topics, self.on_mqtt_message)
+        self.mqtt.connect()
+
+    def _start_device_thread(self, key, device, transform):
+        # the engines import tuyaface, only the one in use is imported
+        if self.engine:
+            # pylint: disable=import-outside-toplevel
+            from .device_async import AsyncDevice
+
+            self.engine.start()
+            thread_object = AsyncDevice(key, device, transform, self, self.engine)
+        else:
+            # pylint: disable=import-outside-toplevel
+            from .device_thread import DeviceThread
+
+            thread_object = DeviceThread(key, device, transform, self)
+            thread_object.setName(f"tuyagateway_{key}")
+        thread_object.start()
+        self.worker_threads[key] = thread_object
+        if self.poller.enabled:
+            self.poller.add(key)
+
+    def _find_device_keys(self, key: str, ip_address=None):
+        keys = self.registry.keys_by_ip(ip_address)
+        if key in self.registry and key not in keys:
+            keys.append(key)
+        return keys
+
+    def _reconfigure_device(self, device: Device, discover_dict: dict, keys) -> bool:
+        """Apply discovery to the running device, false if it needs a restart."""
+        key = device.get_key()
+        running = self.registry.get_device(key)
+        worker = self.worker_threads.get(key)
+        if not running or not worker or not worker.is_alive():
+            return False
+        if set(keys) - {key}:
+            return False
+        if running.get_config() == discover_dict:
+            logger.info("(%s) discovery unchanged", device.get_ip_address())
+            return True
+        if running.get_connection_config() != device.get_connection_config():
+            return False
+        if not worker.is_running():
+            # still waiting for config of the old datapoints
+            return False
+        logger.info("(%s) discovery changed, reconfiguring", device.get_ip_address())
+        worker.reconfigure(discover_dict)
+        return True
+
+    def _handle_discover_message(self, topic: dict, message):
+        """Handle discover message from GismoCaster.
+
+        An identical discover message is ignored, datapoint changes are
+        applied to the running device. If the connection changed we kill
+        the thread for the device (if any), and restart with new config.
+        """
+
+        logger.info(
+            "discovery message received %s topic %s retained %s ",
+            message.payload,
+            message.topic,
+            message.retain,
+        )
+
+        discover_dict = {}
+        try:
+            if message.payload:
+                discover_dict = codec.loads(message.payload)
+        except Exception as ex:
+            print("_handle_discover_message", ex)
+            return
+
+        device_key = topic[2]
+        device = Device(discover_dict)
+        # TODO: check ha_publish
+        if not device.is_valid():
+            return
+
+        self._unconfirmed.discard(device.get_key())
+        self._subscribe_config(device.get_key(), discover_dict)
+        device_keys = self._find_device_keys(device_key, device.get_ip_address())
+        if self._reconfigure_device(device, discover_dict, device_keys):
+            return
+        transform = Transform(self, discover_dict)
+
+        for device_key in device_keys:
+            if device_key in self.worker_threads:
+                try:
+                    self.worker_threads[device_key].stop_entity()
+                    self.worker_threads[device_key].join()
+                except Exception:
+                    pass
+            if device_key != device.get_key():
+                # another device took over the IP address
+                self.registry.remove(device_key)
+                self.mqtt.set_config_topics(device_key, [])
+                self.worker_threads.pop(device_key, None)
+                self.poller.remove(device_key)
+                self.startup.remove(device_key)
+
+        if not device.is_valid():
+            return
+        self._add_device(device, transform)
+
+    def _add_device(self, device: Device, transform: Transform):
+        self.registry.add(device, transform)
+        if self.cluster.enabled and not self.cluster.owns(device.get_key()):
+            # started once the cluster assigns it to this node
+            self.cluster.notify()
+            return
+        self._start_device(device.get_key(), device, transform)
+
+    def _start_device(self, key: str, device: Device, transform: Transform):
+        if self.startup.enabled:
+            self.startup.add(key, device, transform)
+            return
+        self._start_device_thread(key, device, transform)
+
+    def _stop_device(self, key: str):
+        worker = self.worker_threads.pop(key, None)
+        if worker:
+            worker.stop_entity()
+            worker.join()
+        self.poller.remove(key)
+        self.startup.remove(key)
+
+    def _cluster_start(self, key: str):
+        """Start a device the cluster assigned to this node."""
+        if key in self.worker_threads or not self.cluster.owns(key):
+            return
+        device = self.registry.get_device(key)
+        transform = self.registry.get_transform(key)
+        if device is None or transform is None:
+            return
+        logger.info("(%s) assigned to this node", device.get_ip_address())
+        self._start_device(key, device, transform)
+
+    def _cluster_stop(self, key: str):
+        """Stop a device the cluster moved to another node."""
+        if self.cluster.owns(key):
+            # assigned back meanwhile
+            return
+        if key in self.worker_threads:
+            logger.info("%s moved to another node", key)
+        self._stop_device(key)
+
+    async def get_ha_config(self, key: str, idx: int, timeout: float = None) -> dict:
+        """Get the HomeAssistant configuration, wait till it is available."""
+        await self._config_ready.wait(("homeassistant", key, idx), timeout)
+        return self._ha_config[key][idx]
+
+    def get_cached_ha_config(self, key: str, idx: int) -> dict:
+        """Get the HomeAssistant configuration if received, else None."""
+        return self._ha_config.get(key, {}).get(idx)
+
+    def get_cached_ha_component(self, key: str) -> dict:
+        """Get the HomeAssistant component configuration if received, else None."""
+        return self._ha_component.get(key)
+
+    def _handle_ha_config_message(self, topic: dict, message):
+        if not message.payload:
+            return
+        # the topic carries the uniq_id, skip unknown devices before parsing
+        id_parts = topic[2].split("_")
+        if len(id_parts) < 2 or not id_parts[1].isnumeric():
+            return
+        if id_parts[0] not in self.registry:
+            return
+
+        try:
+            ha_dict = codec.loads(message.payload)
+        except Exception as ex:
+            print(ex)
+            return
+        # add context to ha_dict
+        ha_dict["device_component"] = topic[1]
+
+        if topic[2] != ha_dict.get("uniq_id"):
+            return
+        if id_parts[0] not in ha_dict["device"]["identifiers"]:
+            return
+        if id_parts[0] not in self._ha_config:
+            self._ha_config[id_parts[0]] = {}
+        id_int = int(id_parts[1])
+        self._ha_config[id_parts[0]][id_int] = ha_dict
+        self._config_ready.set_ready(("homeassistant", id_parts[0], id_int))
+
+        transform = self.registry.get_transform(id_parts[0])
+        if transform:
+            transform.set_homeassistant_config(id_int, ha_dict)
+        worker = self.worker_threads.get(id_parts[0])
+        if worker and worker.is_running():
+            # topics of a running device may have changed
+            worker.mqtt_connect()
+        self.startup.check(id_parts[0])
+
+    async def get_ha_component(self, key: str, timeout: float = None):
+        """Get the HomeAssistant component configuration, wait till available."""
+        await self._config_ready.wait(("component", key), timeout)
+        return self._ha_component[key]
+
+    def _handle_ha_component_message(self, topic: dict, message):
+
+        logger.info(
+            "config message topic %s retained %s ", message.topic, message.retain,
+        )
+        try:
+            payload_dict = codec.loads(message.payload)
+        except Exception as ex:
+            print(ex)
+            return
+
+        component_name = topic[3]
+        self._ha_component[component_name] = payload_dict
+        self._config_ready.set_ready(("component", component_name))
+
+        for transform in self.registry.transforms_by_component(component_name):
+            transform.set_component_config(payload_dict, component_name)
+        for key in self.registry.keys_by_component(component_name):
+            self.startup.check(key)
+
+    def on_mqtt_message(self, client, userdata, message):
+        """MQTT message callback, executed in the MQTT client's context.
+
+        Handlers may block (stopping devices), so they run on the control worker.
+        """
+        topic_parts = message.topic.split("/")
+        handler = self.inline_router.match(topic_parts)
+        if handler:
+            handler(topic_parts, message)
+            return
+        handler = self.router.match(topic_parts)
+        if handler:
+            self.control.submit_topic(message.topic, handler, topic_parts, message)
+
+    def main_loop(self):
+        """Send / receive from tuya devices."""
+        try:
+            self.mqtt_connect()
+            # TODO: remove main param transform
+            heartbeat = float(self.config["General"].get("state_heartbeat", 0))
+            last_heartbeat = time.monotonic()
+            snapshot = float(self.config["General"].get("snapshot_interval", 300))
+            last_snapshot = time.monotonic()
+            while True:
+                time.sleep(self.delay)
+                if heartbeat and time.monotonic() - last_heartbeat >= heartbeat:
+                    last_heartbeat = time.monotonic()
+                    for thread in list(self.worker_threads.values()):
+                        thread.heartbeat()
+                if (
+                    self._snapshot_file
+                    and snapshot
+                    and time.monotonic() - last_snapshot >= snapshot
+                ):
+                    last_snapshot = time.monotonic()
+                    self.control.submit(self._save_snapshot)
+
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        """Stop config handling, all devices and the MQTT connections."""
+        if self.cluster.enabled:
+            self.cluster.stop()
+        self.startup.stop()
+        self.control.stop()
+        self.poller.stop()
+        for _, thread in self.worker_threads.items():
+            thread.stop_entity()
+            thread.join()
+        if self.cluster.enabled:
+            self.cluster.leave()
+        if self.engine:
+            self.engine.stop()
+        if self._snapshot_file:
+            self._save_snapshot()
+        self.exporter.stop()
+        self.mqtt.stop()
@@ -0,0 +1,62 @@
+"""HashRing, consistent hashing of device ids to nodes."""
+import bisect
+import hashlib
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Map keys to nodes, adding or removing a node only moves its share.
+
+    Each node is placed replicas times on the ring to even out the load.
+    """
+
+    def __init__(self, nodes=(), replicas: int = 100):
+        """Initialize HashRing."""
+        self.replicas = replicas
+        self._nodes = set()
+        self._hashes = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self) -> int:
+        """Return the number of nodes."""
+        return len(self._nodes)
+
+    def nodes(self) -> set:
+        """Return the nodes on the ring."""
+        return set(self._nodes)
+
+    def add(self, node: str):
+        """Place the node on the ring."""
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for replica in range(self.replicas):
+            point = _hash(f"{node}:{replica}")
+            if point in self._owners:
+                # collision, the point stays with the earlier node
+                continue
+            self._owners[point] = node
+            bisect.insort(self._hashes, point)
+
+    def remove(self, node: str):
+        """Take the node off the ring."""
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        for replica in range(self.replicas):
+            point = _hash(f"{node}:{replica}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._hashes.remove(point)
+
+    def get(self, key: str) -> str:
+        """Return the node owning the key, None if the ring is empty."""
+        if not self._hashes:
+            return None
+        idx = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[self._hashes[idx]]
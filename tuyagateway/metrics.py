@@ -0,0 +1,387 @@
+"""Lightweight in-process metrics.
+
+Collection is off till enable() is called, a disabled metric costs one
+attribute lookup per call. render() returns the Prometheus text format,
+snapshot() a JSON serializable summary.
+"""
+import abc
+import bisect
+import math
+import threading
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+NAMESPACE = "tuyagateway"
+
+REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+class _Collection:
+    """Module wide collection switch, flipped by enable()."""
+
+    enabled = False
+
+
+_COLLECTION = _Collection()
+
+
+def enable(enabled: bool = True):
+    """Switch metric collection on or off."""
+    _COLLECTION.enabled = enabled
+
+
+def is_enabled() -> bool:
+    """Return true if metrics are collected."""
+    return _COLLECTION.enabled
+
+
+class _NoopChild:
+    """Stand-in returned by labels() while collection is off."""
+
+    def inc(self, amount: float = 1):
+        """Do nothing."""
+
+    def dec(self, amount: float = 1):
+        """Do nothing."""
+
+    def set(self, value: float):
+        """Do nothing."""
+
+    def observe(self, value: float):
+        """Do nothing."""
+
+
+_NOOP = _NoopChild()
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        """Add amount to the value."""
+        if not _COLLECTION.enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount: float = 1):
+        """Subtract amount from the value."""
+        self.inc(-amount)
+
+    def set(self, value: float):
+        """Set the value."""
+        if _COLLECTION.enabled:
+            self.value = value
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Count the value in its bucket."""
+        if not _COLLECTION.enabled:
+            return
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+            self._count += 1
+
+    def quantile(self, quantile: float) -> float:
+        """Return the upper bound of the bucket holding the quantile."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._count
+        if not total:
+            return None
+        rank = quantile * total
+        cumulative = 0
+        for idx, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                if idx < len(self.buckets):
+                    return self.buckets[idx]
+                return float("inf")
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        """Return cumulative bucket counts, sum and count."""
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+            total = self._count
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {"buckets": buckets, "sum": total_sum, "count": total}
+
+
+class _Metric(abc.ABC):
+    """Metric family, one child per combination of label values."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """Initialize the metric."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._default = None if self.labelnames else self._child(())
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """Return a child holding the value of one combination of labels."""
+
+    def _child(self, values: tuple):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def labels(self, *values):
+        """Return the child of the label values, in labelnames order."""
+        if not _COLLECTION.enabled:
+            return _NOOP
+        return self._child(values)
+
+    def remove(self, *values):
+        """Drop the child of the label values."""
+        with self._lock:
+            self._children.pop(values, None)
+
+    def children(self) -> list:
+        """Return (label values, child) of all children."""
+        with self._lock:
+            return list(self._children.items())
+
+
+class Counter(_Metric):
+    """Monotonic counter."""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        """Increment the unlabeled counter."""
+        self._default.inc(amount)
+
+    def samples(self) -> list:
+        """Return (suffix, label values, value) of all children."""
+        return [("", values, child.value) for values, child in self.children()]
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, optionally read from a function."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """Initialize Gauge."""
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        """Set the unlabeled gauge."""
+        self._default.set(value)
+
+    def inc(self, amount: float = 1):
+        """Increment the unlabeled gauge."""
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1):
+        """Decrement the unlabeled gauge."""
+        self._default.dec(amount)
+
+    def set_function(self, function: callable):
+        """Read the gauge from function() when collected.
+
+        A labeled gauge function returns {label values: value}.
+        """
+        self._function = function
+
+    def samples(self) -> list:
+        """Return (suffix, label values, value) of all children."""
+        if self._function is None:
+            return [("", values, child.value) for values, child in self.children()]
+        try:
+            value = self._function()
+        except Exception:
+            return []
+        if self.labelnames:
+            return [("", values, item) for values, item in value.items()]
+        return [("", (), value)]
+
+
+class Histogram(_Metric):
+    """Bucketed histogram of observed values (seconds)."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets=DEFAULT_BUCKETS,
+        labelnames: tuple = (),
+    ):
+        """Initialize Histogram."""
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        """Add an observation to the unlabeled histogram."""
+        self._default.observe(value)
+
+    def quantile(self, quantile: float) -> float:
+        """Return the upper bound of the bucket holding the quantile."""
+        return self._default.quantile(quantile)
+
+    def snapshot(self) -> dict:
+        """Return cumulative bucket counts, sum and count."""
+        return self._default.snapshot()
+
+    def samples(self) -> list:
+        """Return (suffix, label values, value) of all children."""
+        samples = []
+        for values, child in self.children():
+            summary = child.snapshot()
+            for bound, count in summary["buckets"].items():
+                samples.append(("_bucket", values + (_format_value(bound),), count))
+            samples.append(("_sum", values, summary["sum"]))
+            samples.append(("_count", values, summary["count"]))
+        return samples
+
+
+def _register(cls, name: str, documentation: str, *args):
+    with _REGISTRY_LOCK:
+        if name not in REGISTRY:
+            REGISTRY[name] = cls(name, documentation, *args)
+        return REGISTRY[name]
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    """Return the registered counter, create it if needed."""
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+    """Return the registered gauge, create it if needed."""
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def histogram(
+    name: str, documentation: str, buckets=DEFAULT_BUCKETS, labelnames: tuple = ()
+) -> Histogram:
+    """Return the registered histogram, create it if needed."""
+    return _register(Histogram, name, documentation, buckets, labelnames)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _bound(value: float):
+    # JSON has no infinity, the overflow bucket has no upper bound
+    if value is None or math.isinf(value):
+        return None
+    return value
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = (
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    with _REGISTRY_LOCK:
+        metrics = list(REGISTRY.values())
+    lines = []
+    for metric in metrics:
+        name = f"{NAMESPACE}_{metric.name}"
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for suffix, values, value in metric.samples():
+            names = metric.labelnames
+            if suffix == "_bucket":
+                names += ("le",)
+            labels = _format_labels(names, values)
+            lines.append(f"{name}{suffix}{labels} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    """Return all metrics as a JSON serializable dict.
+
+    Histograms are summarized as count, sum and bucket bound percentiles.
+    """
+    with _REGISTRY_LOCK:
+        metrics = list(REGISTRY.values())
+    result = {}
+    for metric in metrics:
+        items = []
+        if isinstance(metric, Histogram):
+            for values, child in metric.children():
+                summary = child.snapshot()
+                items.append(
+                    {
+                        "labels": dict(zip(metric.labelnames, values)),
+                        "count": summary["count"],
+                        "sum": summary["sum"],
+                        "p50": _bound(child.quantile(0.5)),
+                        "p99": _bound(child.quantile(0.99)),
+                    }
+                )
+        else:
+            for _, values, value in metric.samples():
+                items.append(
+                    {"labels": dict(zip(metric.labelnames, values)), "value": value}
+                )
+        result[metric.name] = items
+    return result
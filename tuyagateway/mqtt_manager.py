@@ -0,0 +1,292 @@
+"""Shared MQTT connections for the gateway and all of its devices."""
+import threading
+import time
+import zlib
+import paho.mqtt.client as mqtt
+from .configure import logger
+from .metrics import counter, histogram
+
+MQTT_CONNECTS = counter(
+    "mqtt_connects_total", "MQTT (re)connects per pool connection.", ("connection",)
+)
+MQTT_DISCONNECTS = counter(
+    "mqtt_disconnects_total",
+    "MQTT connection losses per pool connection.",
+    ("connection",),
+)
+MQTT_PUBLISHES = counter(
+    "mqtt_publish_total", "Messages published per device.", ("device",)
+)
+MQTT_CALLBACK = histogram(
+    "mqtt_callback_seconds",
+    "Time spent in MQTT message callbacks on the paho network loop.",
+    labelnames=("handler",),
+)
+
+
+def connack_string(state):
+    """Return mqtt connection string."""
+    states = [
+        "Connection successful",
+        "Connection refused - incorrect protocol version",
+        "Connection refused - invalid client identifier",
+        "Connection refused - server unavailable",
+        "Connection refused - bad username or password",
+        "Connection refused - not authorised",
+    ]
+    return states[state]
+
+
+class MQTTConnection:
+    """One paho client carrying a share of the devices."""
+
+    def __init__(self, manager, index: int, client: mqtt.Client = None):
+        """Initialize MQTTConnection."""
+        self.index = index
+        self.client = client or mqtt.Client()
+        self.connected = False
+        # (topic, payload) published by the broker when the connection drops
+        self.will = None
+        self._manager = manager
+
+    def connect(self, config: dict):
+        """Connect the paho client and start its network loop."""
+        self.client.enable_logger()
+        if self.will:
+            self.client.will_set(*self.will, retain=True)
+        if config["MQTT"]["user"] and config["MQTT"]["pass"]:
+            self.client.username_pw_set(config["MQTT"]["user"], config["MQTT"]["pass"])
+        self.client.connect_async(
+            config["MQTT"].get("host", "127.0.0.1"),
+            int(config["MQTT"].get("port", 1883)),
+            60,
+        )
+        self.client.on_connect = self.on_mqtt_connect
+        self.client.on_disconnect = self.on_mqtt_disconnect
+        self.client.on_message = self.on_mqtt_message
+        self.client.loop_start()
+
+    def on_mqtt_connect(self, client, userdata, flags, return_code):
+        """MQTT connect callback, executed in the MQTT client's context."""
+        logger.info(
+            "MQTT Connection state: %s for connection %s",
+            connack_string(return_code),
+            self.index,
+        )
+        if return_code != 0:
+            return
+        self.connected = True
+        MQTT_CONNECTS.labels(str(self.index)).inc()
+        self._manager.on_connection_connected(self)
+
+    def on_mqtt_disconnect(self, client, userdata, return_code):
+        """MQTT disconnect callback, executed in the MQTT client's context."""
+        self.connected = False
+        MQTT_DISCONNECTS.labels(str(self.index)).inc()
+        logger.info("MQTT connection %s lost (%s)", self.index, return_code)
+
+    def on_mqtt_message(self, client, userdata, message):
+        """MQTT message callback, executed in the MQTT client's context."""
+        self._manager.on_connection_message(self, message)
+
+    def disconnect(self):
+        """Disconnect and stop the network loop."""
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.connected = False
+
+
+class MQTTManager:
+    """Multiplex publish/subscribe of all devices over a pool of connections.
+
+    Connection 0 is the gateway's own client, it carries the gateway
+    subscriptions. Devices are spread over the pool by a stable hash of
+    their key, incoming messages are routed to the owning device by topic.
+    """
+
+    def __init__(self, config: dict, client: mqtt.Client = None):
+        """Initialize MQTTManager."""
+        self.config = config
+        # the devices share connections, each one can only have one will, so
+        # the wills mark the gateway offline instead of each device
+        general = config["General"] if "General" in config else {}
+        self.status_topic = general.get("status_topic", "tuyagateway/status")
+        self._status_online = general.get("availability_online", "online")
+        self._status_offline = general.get("availability_offline", "offline")
+        pool_size = max(1, int(config["MQTT"].get("connections", 1)))
+        cluster = config["Cluster"] if "Cluster" in config else {}
+        if self.status_topic and cluster.get("node_id"):
+            # connection 0 carries the cluster node will, another one the status
+            pool_size = max(2, pool_size)
+        self._connections = [MQTTConnection(self, 0, client)]
+        for idx in range(1, pool_size):
+            self._connections.append(MQTTConnection(self, idx))
+        self._lock = threading.Lock()
+        # topic -> (device key, callback)
+        self._routes = {}
+        # device key -> (topics, on_connect callback)
+        self._devices = {}
+        self._gateway_topics = []
+        # device key -> config topics the gateway subscribes for the device
+        self._config_topics = {}
+        self._gateway_handler = None
+        if self.status_topic:
+            for connection in self._connections:
+                connection.will = (self.status_topic, self._status_offline)
+
+    def connect(self):
+        """Connect all connections of the pool."""
+        for connection in self._connections:
+            connection.connect(self.config)
+
+    def stop(self):
+        """Mark the gateway offline, then disconnect all connections."""
+        status = self._status_connections()
+        if status and status[0].connected:
+            status[0].client.publish(
+                self.status_topic, self._status_offline, retain=True
+            )
+        for connection in self._connections:
+            connection.disconnect()
+
+    def set_will(self, topic: str, payload):
+        """Replace the will of the gateway's own connection.
+
+        The other connections keep the status will, with a single connection
+        the status topic isn't published.
+        """
+        self._connections[0].will = (topic, payload)
+
+    def _status_connections(self) -> list:
+        return [
+            connection
+            for connection in self._connections
+            if connection.will == (self.status_topic, self._status_offline)
+        ]
+
+    def _publish_status(self):
+        """Mark the gateway online once all its connections are up."""
+        status = self._status_connections()
+        if status and all(connection.connected for connection in status):
+            status[0].client.publish(
+                self.status_topic, self._status_online, retain=True
+            )
+
+    def set_gateway_handler(self, topics: list, handler: callable):
+        """Set the gateway subscriptions and their message handler."""
+        self._gateway_topics = topics
+        self._gateway_handler = handler
+
+    def set_config_topics(self, key: str, topics: list):
+        """Subscribe the gateway to the config topics of a device.
+
+        Replaces the earlier config topics of the device, an empty list
+        unsubscribes them. Unchanged topics aren't subscribed again, so the
+        broker doesn't resend their retained config.
+        """
+        connection = self._connections[0]
+        with self._lock:
+            old_topics = self._config_topics.pop(key, [])
+            if topics:
+                self._config_topics[key] = topics
+        new_topics = {topic for topic, _ in topics}
+        stale = [topic for topic, _ in old_topics if topic not in new_topics]
+        added = [item for item in topics if item not in old_topics]
+        if connection.connected and stale:
+            connection.client.unsubscribe(stale)
+        if connection.connected and added:
+            connection.client.subscribe(added)
+
+    def connection_for(self, key: str) -> MQTTConnection:
+        """Return the connection carrying the device."""
+        if len(self._connections) == 1:
+            return self._connections[0]
+        idx = zlib.crc32(key.encode("utf-8")) % len(self._connections)
+        return self._connections[idx]
+
+    def register(
+        self, key: str, topics: list, on_message: callable, on_connect: callable = None,
+    ):
+        """Subscribe the device topics and route their messages to the device.
+
+        Registering again replaces the topics of the device.
+        """
+        connection = self.connection_for(key)
+        new_topics = {topic for topic, _ in topics}
+        with self._lock:
+            old_topics, _ = self._devices.get(key, ([], None))
+            stale = []
+            for topic, _ in old_topics:
+                route = self._routes.get(topic)
+                if topic not in new_topics and route and route[0] == key:
+                    del self._routes[topic]
+                    stale.append(topic)
+            self._devices[key] = (topics, on_connect)
+            for topic, _ in topics:
+                self._routes[topic] = (key, on_message)
+        if connection.connected and stale:
+            connection.client.unsubscribe(stale)
+        if connection.connected and topics:
+            connection.client.subscribe(topics)
+
+    def unregister(self, key: str):
+        """Remove the device routes and unsubscribe its topics."""
+        connection = self.connection_for(key)
+        with self._lock:
+            topics, _ = self._devices.pop(key, ([], None))
+            stale = []
+            for topic, _ in topics:
+                route = self._routes.get(topic)
+                if route and route[0] == key:
+                    del self._routes[topic]
+                    stale.append(topic)
+        if connection.connected and stale:
+            connection.client.unsubscribe(stale)
+
+    def publish(self, key: str, topic: str, payload, retain: bool = False):
+        """Publish on the connection carrying the device."""
+        MQTT_PUBLISHES.labels(key).inc()
+        return self.connection_for(key).client.publish(topic, payload, retain=retain)
+
+    def publish_gateway(self, topic: str, payload, retain: bool = False):
+        """Publish on the gateway's own connection."""
+        return self._connections[0].client.publish(topic, payload, retain=retain)
+
+    def on_connection_connected(self, connection: MQTTConnection):
+        """(Re)subscribe everything carried by the connection."""
+        if connection.index == 0:
+            with self._lock:
+                topics = self._gateway_topics + [
+                    topic
+                    for config_topics in self._config_topics.values()
+                    for topic in config_topics
+                ]
+            if topics:
+                connection.client.subscribe(topics)
+
+        with self._lock:
+            devices = [
+                (key, item)
+                for key, item in self._devices.items()
+                if self.connection_for(key) is connection
+            ]
+        topics = [topic for _, (dev_topics, _) in devices for topic in dev_topics]
+        if topics:
+            connection.client.subscribe(topics)
+        for _, (_, on_connect) in devices:
+            if on_connect:
+                on_connect()
+        if self.status_topic:
+            self._publish_status()
+
+    def on_connection_message(self, connection: MQTTConnection, message):
+        """Route a message to its device, or to the gateway handler."""
+        started = time.monotonic()
+        route = self._routes.get(message.topic)
+        if route and self.connection_for(route[0]) is connection:
+            route[1](message)
+            MQTT_CALLBACK.labels("device").observe(time.monotonic() - started)
+            return
+        if connection.index == 0 and self._gateway_handler:
+            self._gateway_handler(connection.client, None, message)
+            MQTT_CALLBACK.labels("gateway").observe(time.monotonic() - started)
@@ -0,0 +1,156 @@
+"""PollScheduler, spreads status polls of all devices over time."""
+import heapq
+import random
+import threading
+import time
+from .configure import logger
+from .metrics import counter, gauge
+
+POLLS = counter("polls_total", "Status polls by result.", ("result",))
+POLLS_IN_FLIGHT = gauge("polls_in_flight", "Status polls waiting for a reply.")
+
+
+class PollScheduler(threading.Thread):
+    """Poll devices with jitter, backoff and a global concurrency cap.
+
+    dispatch(key, on_done) starts a poll and returns false if the device
+    can't be polled now, the device calls on_done(key, success) when done.
+    """
+
+    def __init__(self, config: dict, dispatch: callable):
+        """Initialize PollScheduler."""
+        super().__init__(name="tuyagateway_poller", daemon=True)
+        general = config["General"]
+        self.interval = float(general.get("poll_interval", 0))
+        self.fast_interval = float(general.get("poll_fast_interval", self.interval / 4))
+        self.recent = float(general.get("poll_recent", self.interval))
+        self.jitter = float(general.get("poll_jitter", 0.1))
+        self.max_backoff = float(general.get("poll_max_backoff", 600))
+        self.max_in_flight = max(1, int(general.get("poll_concurrency", 10)))
+        self.timeout = float(general.get("poll_timeout", 30))
+        self._dispatch = dispatch
+        self._condition = threading.Condition()
+        self._heap = []
+        # key -> due time, heap entries with another due time are stale
+        self._due = {}
+        self._failures = {}
+        self._last_change = {}
+        self._in_flight = {}
+        self._stopping = False
+        POLLS_IN_FLIGHT.set_function(lambda: len(self._in_flight))
+
+    @property
+    def enabled(self) -> bool:
+        """Return true if polling is configured."""
+        return self.interval > 0
+
+    def _jittered(self, delay: float) -> float:
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _schedule(self, key: str, delay: float):
+        due = time.monotonic() + delay
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        self._condition.notify()
+
+    def add(self, key: str):
+        """Start polling the device, the first poll is spread over an interval."""
+        with self._condition:
+            self._failures.pop(key, None)
+            self._in_flight.pop(key, None)
+            self._schedule(key, random.uniform(0, self.interval))
+
+    def remove(self, key: str):
+        """Stop polling the device."""
+        with self._condition:
+            self._due.pop(key, None)
+            self._failures.pop(key, None)
+            self._last_change.pop(key, None)
+            self._in_flight.pop(key, None)
+            self._condition.notify()
+
+    def changed(self, key: str):
+        """Mark the device changed, it is polled at the fast interval for a while."""
+        self._last_change[key] = time.monotonic()
+
+    def _next_delay(self, key: str, success: bool) -> float:
+        if not success:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            # capped, a float overflows after about 1000 doublings
+            return self._jittered(
+                min(
+                    self.interval * 2 ** min(failures, 32),
+                    max(self.max_backoff, self.interval),
+                )
+            )
+        self._failures.pop(key, None)
+        last_change = self._last_change.get(key)
+        if last_change is not None and time.monotonic() - last_change < self.recent:
+            return self._jittered(self.fast_interval)
+        return self._jittered(self.interval)
+
+    def on_done(self, key: str, success: bool):
+        """Poll finished callback, executed in the device's context."""
+        POLLS.labels("ok" if success else "failed").inc()
+        with self._condition:
+            if self._in_flight.pop(key, None) is None:
+                # removed or timed out meanwhile
+                return
+            self._schedule(key, self._next_delay(key, success))
+
+    def _expire(self, now: float):
+        for key, started in list(self._in_flight.items()):
+            if now - started < self.timeout:
+                continue
+            logger.warning("poll of %s timed out", key)
+            POLLS.labels("timeout").inc()
+            del self._in_flight[key]
+            self._schedule(key, self._next_delay(key, False))
+
+    def _next_due(self) -> tuple:
+        """Pop the next due key, or return the time to wait."""
+        now = time.monotonic()
+        self._expire(now)
+        while self._heap:
+            due, key = self._heap[0]
+            if self._due.get(key) != due:
+                heapq.heappop(self._heap)
+                continue
+            if due > now:
+                return None, due - now
+            if len(self._in_flight) >= self.max_in_flight:
+                return None, min(1.0, self.timeout)
+            heapq.heappop(self._heap)
+            del self._due[key]
+            self._in_flight[key] = now
+            return key, 0
+        return None, self.timeout if self._in_flight else None
+
+    def run(self):
+        """Poll loop, dispatches polls when due."""
+        while True:
+            with self._condition:
+                key, wait = self._next_due()
+                while key is None:
+                    if self._stopping:
+                        return
+                    self._condition.wait(wait)
+                    key, wait = self._next_due()
+            try:
+                dispatched = self._dispatch(key, self.on_done)
+            except Exception:
+                logger.exception("poll of %s failed", key)
+                dispatched = False
+            if not dispatched:
+                with self._condition:
+                    if self._in_flight.pop(key, None) is not None:
+                        self._schedule(key, self._jittered(self.interval))
+
+    def stop(self):
+        """Stop the poll loop."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,37 @@
+"""Per key readiness of configuration."""
+import asyncio
+import concurrent.futures
+import threading
+
+
+class ConfigReadiness:
+    """Keys are marked ready from the MQTT thread and awaited from any loop."""
+
+    def __init__(self):
+        """Initialize ConfigReadiness."""
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _future(self, key) -> concurrent.futures.Future:
+        with self._lock:
+            if key not in self._futures:
+                self._futures[key] = concurrent.futures.Future()
+            return self._futures[key]
+
+    def set_ready(self, key):
+        """Mark key ready, wakes up all waiters."""
+        future = self._future(key)
+        if not future.done():
+            future.set_result(True)
+
+    def is_ready(self, key) -> bool:
+        """Return true if the key is ready."""
+        return self._future(key).done()
+
+    async def wait(self, key, timeout: float = None):
+        """Wait till key is ready, raises asyncio.TimeoutError."""
+        future = self._future(key)
+        if future.done():
+            return
+        # shield, a timeout must not cancel the future shared by all waiters
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
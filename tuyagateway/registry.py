@@ -0,0 +1,85 @@
+"""Registry of the configured devices."""
+import threading
+from .device import Device
+from tuyagateway.transform.homeassistant import Transform
+
+
+class DeviceRegistry:
+    """Devices and their transforms, indexed by device id, IP and component."""
+
+    def __init__(self):
+        """Initialize DeviceRegistry."""
+        self._devices = {}
+        self._transforms = {}
+        self._by_ip = {}
+        self._by_component = {}
+        # device id -> (ip address, component names) as indexed
+        self._indexed = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        """Return true if the device id is registered."""
+        return key in self._devices
+
+    def __len__(self) -> int:
+        """Return the number of registered devices."""
+        return len(self._devices)
+
+    def keys(self) -> list:
+        """Return the registered device ids."""
+        return list(self._devices)
+
+    def get_device(self, key: str) -> Device:
+        """Return Device by device id."""
+        return self._devices.get(key)
+
+    def get_transform(self, key: str) -> Transform:
+        """Return Transform by device id."""
+        return self._transforms.get(key)
+
+    def keys_by_ip(self, ip_address: str) -> list:
+        """Return the device ids using the IP address."""
+        with self._lock:
+            return list(self._by_ip.get(ip_address, ()))
+
+    def keys_by_component(self, component_name: str) -> list:
+        """Return the device ids with a datapoint of the component."""
+        with self._lock:
+            return list(self._by_component.get(component_name, ()))
+
+    def transforms_by_component(self, component_name: str) -> list:
+        """Return the transforms with a datapoint of the component."""
+        with self._lock:
+            return [
+                self._transforms[key]
+                for key in self._by_component.get(component_name, ())
+            ]
+
+    def _unindex(self, key: str):
+        if key not in self._indexed:
+            return
+        ip_address, component_names = self._indexed.pop(key)
+        self._by_ip.get(ip_address, set()).discard(key)
+        for component_name in component_names:
+            self._by_component.get(component_name, set()).discard(key)
+
+    def add(self, device: Device, transform: Transform):
+        """Register or replace the device and its transform, also to reindex."""
+        key = device.get_key()
+        ip_address = device.get_ip_address()
+        component_names = transform.get_component_names()
+        with self._lock:
+            self._unindex(key)
+            self._devices[key] = device
+            self._transforms[key] = transform
+            self._indexed[key] = (ip_address, component_names)
+            self._by_ip.setdefault(ip_address, set()).add(key)
+            for component_name in component_names:
+                self._by_component.setdefault(component_name, set()).add(key)
+
+    def remove(self, key: str):
+        """Remove the device from the registry."""
+        with self._lock:
+            self._unindex(key)
+            self._devices.pop(key, None)
+            self._transforms.pop(key, None)
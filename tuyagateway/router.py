@@ -0,0 +1,49 @@
+"""TopicRouter, dispatch MQTT topics to handlers by subscription pattern."""
+
+
+class _Node:
+    __slots__ = ("children", "handler")
+
+    def __init__(self):
+        self.children = {}
+        self.handler = None
+
+
+class TopicRouter:
+    """Trie of topic levels, patterns may use the + and # wildcards.
+
+    Topics are matched level by level without touching the payload, so
+    irrelevant messages are rejected before any decoding. Exact levels win
+    over +, + wins over #.
+    """
+
+    def __init__(self):
+        """Initialize TopicRouter."""
+        self._root = _Node()
+
+    def add(self, pattern: str, handler: callable):
+        """Route topics matching the pattern to handler(topic_parts, message)."""
+        node = self._root
+        for level in pattern.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.handler = handler
+
+    def match(self, topic_parts: list) -> callable:
+        """Return the handler of the split topic, None if no pattern matches."""
+        return self._match(self._root, topic_parts, 0)
+
+    def _match(self, node: _Node, topic_parts: list, idx: int) -> callable:
+        if idx == len(topic_parts):
+            if node.handler:
+                return node.handler
+            wildcard = node.children.get("#")
+            return wildcard.handler if wildcard else None
+        children = node.children
+        for level in (topic_parts[idx], "+"):
+            child = children.get(level)
+            if child is not None:
+                handler = self._match(child, topic_parts, idx + 1)
+                if handler:
+                    return handler
+        wildcard = children.get("#")
+        return wildcard.handler if wildcard else None
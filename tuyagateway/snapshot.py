@@ -0,0 +1,69 @@
+"""Snapshot of config and last known state, for warm restarts."""
+import contextlib
+import json
+import os
+from .configure import logger
+
+SNAPSHOT_VERSION = 1
+
+
+def _int_keys(values: dict) -> dict:
+    return {int(key): value for key, value in values.items()}
+
+
+class Snapshot:
+    """Config and datapoint state of all devices in a compact JSON file.
+
+    discovery: device id -> GismoCaster discovery config
+    homeassistant: device id -> datapoint -> Home Assistant config
+    components: component name -> component config
+    state: device id -> datapoint -> last known Tuya value
+    """
+
+    def __init__(self, path: str):
+        """Initialize Snapshot."""
+        self.path = path
+        self.discovery = {}
+        self.homeassistant = {}
+        self.components = {}
+        self.state = {}
+
+    def load(self) -> bool:
+        """Read the snapshot file, false if there is no usable snapshot."""
+        try:
+            with open(self.path, encoding="utf-8") as snapshot_file:
+                data = json.load(snapshot_file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            logger.warning("snapshot %s unreadable, ignored", self.path, exc_info=True)
+            return False
+        if data.get("version") != SNAPSHOT_VERSION:
+            logger.warning("snapshot %s has another version, ignored", self.path)
+            return False
+        self.discovery = data.get("discovery", {})
+        self.homeassistant = {
+            key: _int_keys(configs)
+            for key, configs in data.get("homeassistant", {}).items()
+        }
+        self.components = data.get("components", {})
+        self.state = data.get("state", {})
+        return True
+
+    def save(self):
+        """Write the snapshot file atomically."""
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "discovery": self.discovery,
+            "homeassistant": self.homeassistant,
+            "components": self.components,
+            "state": self.state,
+        }
+        tmp_path = f"{self.path}.tmp"
+        # holds the device local keys, readable by the owner only
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        handle = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(handle, "w", encoding="utf-8") as snapshot_file:
+            json.dump(data, snapshot_file, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
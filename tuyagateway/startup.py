@@ -0,0 +1,118 @@
+"""StartupPipeline, starts discovered devices in waves once their config is in."""
+import collections
+import threading
+import time
+from .configure import logger
+from .metrics import gauge
+
+STARTUP_DEVICES = gauge("startup_devices", "Devices not started yet.", ("stage",))
+
+
+class StartupPipeline(threading.Thread):
+    """Hold discovered devices till their config is complete, then start them.
+
+    Ready devices are started startup_wave_size at a time, one wave every
+    startup_wave_interval seconds. Waves run on the control worker, so they
+    don't race with discovery handling. Devices still incomplete after
+    startup_timeout are started anyway and wait for their config as before.
+    """
+
+    def __init__(self, config: dict, control, start: callable):
+        """Initialize StartupPipeline."""
+        super().__init__(name="tuyagateway_startup", daemon=True)
+        general = config["General"]
+        self.wave_size = int(general.get("startup_wave_size", 0))
+        self.wave_interval = float(general.get("startup_wave_interval", 1))
+        self.timeout = float(general.get("startup_timeout", 60))
+        self._control = control
+        self._start = start
+        self._condition = threading.Condition()
+        # key -> (device, transform, added)
+        self._pending = {}
+        self._ready = collections.OrderedDict()
+        self._wave_queued = False
+        self._stopping = False
+        STARTUP_DEVICES.set_function(
+            lambda: {("pending",): len(self._pending), ("ready",): len(self._ready)}
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """Return true if devices are started in waves."""
+        return self.wave_size > 0
+
+    def add(self, key: str, device, transform):
+        """Add a discovered device, replaces an earlier one with the same key."""
+        with self._condition:
+            self._ready.pop(key, None)
+            self._pending[key] = (device, transform, time.monotonic())
+        self.check(key)
+
+    def remove(self, key: str):
+        """Forget a device that wasn't started yet."""
+        with self._condition:
+            self._pending.pop(key, None)
+            self._ready.pop(key, None)
+
+    def check(self, key: str):
+        """Move the device to ready if all of its config arrived."""
+        with self._condition:
+            item = self._pending.get(key)
+            if not item or not item[1].is_config_ready():
+                return
+            del self._pending[key]
+            self._ready[key] = item[:2]
+            self._condition.notify()
+
+    def _expire(self, now: float):
+        for key, (device, transform, added) in list(self._pending.items()):
+            if now - added < self.timeout:
+                continue
+            logger.warning(
+                "(%s) config incomplete after %.0fs, starting anyway",
+                device.get_ip_address(),
+                now - added,
+            )
+            del self._pending[key]
+            self._ready[key] = (device, transform)
+
+    def _start_wave(self):
+        """Start the next wave, executed on the control worker."""
+        with self._condition:
+            self._wave_queued = False
+            wave = []
+            while self._ready and len(wave) < self.wave_size:
+                wave.append(self._ready.popitem(last=False))
+        for key, (device, transform) in wave:
+            try:
+                self._start(key, device, transform)
+            except Exception:
+                logger.exception("(%s) start failed", device.get_ip_address())
+        if wave:
+            logger.info("started %s devices, %s ready", len(wave), len(self._ready))
+
+    def run(self):
+        """Queue a wave every wave interval while devices are ready."""
+        last_wave = None
+        with self._condition:
+            while not self._stopping:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self.wave_interval if self._ready or self._pending else None
+                if self._ready and not self._wave_queued:
+                    due = 0 if last_wave is None else last_wave + wait - now
+                    if due <= 0:
+                        self._control.submit(self._start_wave)
+                        self._wave_queued = True
+                        last_wave = now
+                    else:
+                        wait = due
+                self._condition.wait(wait)
+
+    def stop(self):
+        """Stop queueing waves."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,304 @@
+"""Supervisor, shards the devices over worker processes."""
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import paho.mqtt.client as mqtt
+from . import codec
+from .cluster import ClusterMembership
+from .gateway import GATEWAY_TOPICS, TuyaMQTT, ha_config_topics
+from .configure import logger, setup_logging
+from .hashring import HashRing
+from .mqtt_manager import MQTTManager
+from .router import TopicRouter
+
+
+def _sections(config) -> list:
+    if hasattr(config, "sections"):
+        return config.sections()
+    return list(config)
+
+
+def _worker_config(config, idx: int) -> dict:
+    """Return the config of worker idx, files and ports can't be shared."""
+    worker_config = {name: dict(config[name]) for name in _sections(config)}
+    # the supervisor is the cluster node, the workers get the devices it owns
+    cluster = worker_config.pop("Cluster", {})
+    general = worker_config.setdefault("General", {})
+    status_topic = general.get("status_topic", "tuyagateway/status")
+    if status_topic:
+        general["status_topic"] = f"{status_topic}/{idx}"
+    if general.get("snapshot_file") and cluster.get("node_id"):
+        # the snapshot devices would start before the cluster assigns them
+        general["snapshot_file"] = ""
+    elif general.get("snapshot_file"):
+        general["snapshot_file"] = f"{general['snapshot_file']}.{idx}"
+    metrics = worker_config.get("Metrics", {})
+    if int(metrics.get("http_port", 0) or 0):
+        metrics["http_port"] = str(int(metrics["http_port"]) + idx)
+    if metrics.get("mqtt_topic"):
+        metrics["mqtt_topic"] = f"{metrics['mqtt_topic']}/{idx}"
+    return worker_config
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _feed(gateway: TuyaMQTT, inbox, parent_pid: int):
+    """Pass the forwarded messages on to the gateway, stop once orphaned."""
+    while True:
+        try:
+            item = inbox.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                logger.warning("supervisor gone, stopping worker")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            continue
+        topic, payload, retain = item
+        if topic is None:
+            # the device moved to another cluster node, payload is its id
+            gateway.control.submit(gateway.remove_device, payload)
+            continue
+        message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+        message.payload = payload
+        message.retain = retain
+        gateway.on_mqtt_message(None, None, message)
+
+
+def _run_worker(config: dict, inbox, parent_pid: int, log_level: str):
+    """Worker process main, a gateway fed by the supervisor."""
+    setup_logging(log_level)
+    # the supervisor stops workers with SIGTERM, also on Ctrl C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    gateway = TuyaMQTT(config, subscribe=False)
+    threading.Thread(
+        target=_feed,
+        args=(gateway, inbox, parent_pid),
+        name="tuyagateway_feed",
+        daemon=True,
+    ).start()
+    gateway.main_loop()
+
+
+class Supervisor:
+    """Run the devices in worker processes, assigned by consistent hashing.
+
+    The supervisor holds the gateway subscriptions. Discovery and Home
+    Assistant config of a device go to the worker owning the device id,
+    component config goes to all workers. Crashed workers are restarted
+    and get the config of their devices again.
+
+    In cluster mode the supervisor is the node, only the devices the
+    cluster assigns to it are passed on to the workers.
+    """
+
+    delay = 0.5
+
+    def __init__(self, config):
+        """Initialize Supervisor."""
+        self.config = config
+        general = config["General"]
+        self.workers = max(1, int(general.get("workers", 0)))
+        self.restart_delay = float(general.get("worker_restart_delay", 5))
+        self._ring = HashRing(str(idx) for idx in range(self.workers))
+        # forking while the MQTT thread runs could copy a held lock
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = {}
+        self._inboxes = {}
+        self._started = {}
+        self._stopping = False
+        self._lock = threading.Lock()
+        # last config per topic, replayed to restarted workers
+        self._components = {}
+        self._discovery = {}
+        self._ha_configs = {}
+        mqtt_config = {
+            name: dict(config[name])
+            for name in ("General", "MQTT", "Cluster")
+            if name in config
+        }
+        mqtt_config["MQTT"]["connections"] = 1
+        self.mqtt = MQTTManager(mqtt_config, mqtt.Client())
+        self.cluster = ClusterMembership(
+            config,
+            self.mqtt,
+            self._discovered_keys,
+            self._cluster_start,
+            self._cluster_stop,
+        )
+        self.router = TopicRouter()
+        self.router.add("tuyagateway/discovery/+", self._on_discovery)
+        self.router.add("tuyagateway/config/homeassistant/+", self._on_component)
+        self.router.add("homeassistant/+/+/config", self._on_ha_config)
+
+    def owner(self, key: str) -> int:
+        """Return the worker owning the device."""
+        return int(self._ring.get(key))
+
+    def _forward(self, idx: int, topic: str, payload: bytes, retain: bool):
+        inbox = self._inboxes.get(idx)
+        if inbox is not None:
+            inbox.put((topic, payload, retain))
+
+    def _runs_here(self, key: str) -> bool:
+        """Return true if the device runs on this node."""
+        return not self.cluster.enabled or self.cluster.owns(key)
+
+    def _replay(self, idx: int, key: str):
+        """Pass the discovery and Home Assistant config of the device to a worker."""
+        topic, payload = self._discovery[key]
+        self._forward(idx, topic, payload, True)
+        for ha_topic, ha_payload in self._ha_configs.get(key, {}).items():
+            self._forward(idx, ha_topic, ha_payload, True)
+
+    def _discovered_keys(self) -> list:
+        with self._lock:
+            return list(self._discovery)
+
+    def _cluster_start(self, key: str):
+        """Pass a device the cluster assigned to this node to its worker."""
+        with self._lock:
+            if key in self._discovery and self.cluster.owns(key):
+                logger.info("%s assigned to this node", key)
+                self._replay(self.owner(key), key)
+
+    def _cluster_stop(self, key: str):
+        """Remove a device the cluster moved to another node from its worker."""
+        with self._lock:
+            if not self.cluster.owns(key):
+                logger.info("%s moved to another node", key)
+                # no topic, the worker removes the device
+                self._forward(self.owner(key), None, key, False)
+
+    def _on_discovery(self, topic_parts: list, message):
+        key = topic_parts[2]
+        discover_dict = {}
+        try:
+            if message.payload:
+                discover_dict = codec.loads(message.payload)
+        except ValueError:
+            logger.warning("invalid discovery message on %s", message.topic)
+        if not isinstance(discover_dict, dict) or not discover_dict.get("deviceid"):
+            # invalid, the worker ignores it as well
+            self._forward(self.owner(key), message.topic, message.payload, False)
+            return
+        key = discover_dict["deviceid"]
+        with self._lock:
+            self._discovery[key] = (message.topic, message.payload)
+            runs_here = self._runs_here(key)
+            if runs_here:
+                self._forward(self.owner(key), message.topic, message.payload, False)
+        if not runs_here:
+            # passed on once the cluster assigns it to this node
+            self.cluster.notify()
+        self.mqtt.set_config_topics(key, ha_config_topics(key, discover_dict))
+
+    def _on_component(self, topic_parts: list, message):
+        with self._lock:
+            self._components[message.topic] = message.payload
+            for idx in self._inboxes:
+                self._forward(idx, message.topic, message.payload, False)
+
+    def _on_ha_config(self, topic_parts: list, message):
+        key = topic_parts[2].split("_")[0]
+        with self._lock:
+            self._ha_configs.setdefault(key, {})[message.topic] = message.payload
+            if self._runs_here(key):
+                self._forward(self.owner(key), message.topic, message.payload, False)
+
+    def on_mqtt_message(self, client, userdata, message):
+        """MQTT message callback, executed in the MQTT client's context."""
+        topic_parts = message.topic.split("/")
+        handler = self.router.match(topic_parts)
+        if handler:
+            handler(topic_parts, message)
+
+    def _start_worker(self, idx: int):
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=_run_worker,
+            args=(
+                _worker_config(self.config, idx),
+                inbox,
+                os.getpid(),
+                logging.getLevelName(logging.getLogger().getEffectiveLevel()),
+            ),
+            name=f"tuyagateway_worker_{idx}",
+            daemon=True,
+        )
+        process.start()
+        logger.info("worker %s started, pid %s", idx, process.pid)
+        with self._lock:
+            self._processes[idx] = process
+            self._inboxes[idx] = inbox
+            self._started[idx] = time.monotonic()
+            # config received so far, components first
+            for topic, payload in self._components.items():
+                inbox.put((topic, payload, True))
+            for key in self._discovery:
+                if self.owner(key) == idx and self._runs_here(key):
+                    self._replay(idx, key)
+
+    def _check_workers(self):
+        """Restart crashed workers, at most once per restart delay."""
+        for idx, process in list(self._processes.items()):
+            if process.is_alive() or self._stopping:
+                continue
+            if time.monotonic() - self._started[idx] < self.restart_delay:
+                continue
+            logger.error("worker %s exited (%s), restarting", idx, process.exitcode)
+            with self._lock:
+                self._inboxes.pop(idx, None)
+            self._start_worker(idx)
+
+    def start(self):
+        """Start the workers, then subscribe the gateway topics."""
+        for idx in range(self.workers):
+            self._start_worker(idx)
+        gateway_topics = GATEWAY_TOPICS
+        if self.cluster.enabled:
+            gateway_topics = gateway_topics + self.cluster.topics()
+            self.router.add(
+                f"{self.cluster.topic}/nodes/+", self.cluster.on_node_message
+            )
+            self.router.add(
+                f"{self.cluster.topic}/leases/+", self.cluster.on_lease_message
+            )
+            self.cluster.set_will()
+            self.cluster.start()
+        self.mqtt.set_gateway_handler(gateway_topics, self.on_mqtt_message)
+        self.mqtt.connect()
+
+    def main_loop(self):
+        """Watch the workers till interrupted."""
+        try:
+            self.start()
+            while True:
+                time.sleep(self.delay)
+                self._check_workers()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        """Stop the workers, then leave the cluster and disconnect."""
+        self._stopping = True
+        if self.cluster.enabled:
+            self.cluster.stop()
+        processes = list(self._processes.values())
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                logger.warning("worker pid %s didn't stop, killing", process.pid)
+                process.kill()
+        if self.cluster.enabled:
+            self.cluster.leave()
+        self.mqtt.stop()
@@ -1,23 +1,99 @@
 """Transformer for Home assistant."""
-import json
+from tuyagateway import codec
 
 
-def _subscribe_topic(item: dict) -> tuple:
-    return (item["full"], 0)
+def _value_map(values: list, from_key: str, to_key: str) -> dict:
+    """Map from_key to to_key of the topic values, first match wins."""
+    value_map = {}
+    for item in values:
+        try:
+            value_map.setdefault(item[from_key], item[to_key])
+        except TypeError:
+            # unhashable values can't be looked up
+            continue
+    return value_map
 
 
-def _get_topic_value(output_topic, data):
-    value = list(
-        filter(lambda item: item["tuya_value"] == data, output_topic["values"])
-    )
-    if len(value) == 0:
+def _lookup(value_map: dict, data):
+    try:
+        return value_map.get(data)
+    except TypeError:
         return None
-    return value[0]["default_value"]
+
+
+# (component, device topic) -> (component config, lookup tables), the tables
+# are shared by all datapoints and rebuilt when the component config changes
+_COMPILED = {}
+
+
+def _compile(component_config: dict, device_topic: str) -> tuple:
+    """Build the lookup tables used on every message."""
+    topics_by_type = {}
+    topic_by_type_and_name = {}
+    topic_values = {}
+    command_values = None
+    for topic in component_config["topics"]:
+        type_and_name = (topic["topic_type"], topic["name"])
+        topics_by_type.setdefault(topic["topic_type"], []).append(topic)
+        topic_by_type_and_name.setdefault(type_and_name, topic)
+        topic_values.setdefault(
+            type_and_name,
+            _value_map(topic.get("values", []), "tuya_value", "default_value"),
+        )
+        if (
+            command_values is None
+            and "publish_topic" in topic
+            and topic["publish_topic"] == device_topic
+        ):
+            command_values = _value_map(topic["values"], "default_value", "tuya_value")
+    return topics_by_type, topic_by_type_and_name, topic_values, command_values
+
+
+class _EncodedPayload:
+    """Serialized dict, only encoded again when the dict changed.
+
+    Callers update their dicts in place, so a shallow copy is compared.
+    """
+
+    __slots__ = ("_data", "_payload")
+
+    def __init__(self):
+        self._data = None
+        self._payload = None
+
+    def encode(self, data) -> bytes:
+        """Return the JSON payload of data, encoded again if data changed."""
+        if self._payload is None or data != self._data:
+            self._data = dict(data) if data is not None else None
+            self._payload = codec.compact(codec.dumps(data))
+        return self._payload
 
 
 class TransformDataPoint:
     """Transform DataPoint."""
 
+    __slots__ = (
+        "_main",
+        "_is_valid",
+        "_device_key",
+        "_dp_key",
+        "_command_value",
+        "_state_data",
+        "_via",
+        "_changed",
+        "_attribute_payload",
+        "data_point",
+        "component_config",
+        "homeassistant_config",
+        "_topics_by_type",
+        "_topic_by_type_and_name",
+        "_topic_values",
+        "_command_values",
+        "_subscribe_topics",
+        "_publish_topics",
+        "_availability",
+    )
+
     def __init__(self, main, device_key: str, data_point: dict):
         """Initialize TransformDataPoint."""
         self._main = main
@@ -26,21 +102,52 @@ class TransformDataPoint:
         self._dp_key = data_point["key"]
         self._command_value = None
         self._state_data = None
-        self._attribute_data = {}
+        self._via = None
+        self._changed = False
+        self._attribute_payload = None
         self.data_point = data_point
         self.component_config = None
         self.homeassistant_config = None
-
-    async def update_config(self):
+        self._topics_by_type = {}
+        self._topic_by_type_and_name = {}
+        self._topic_values = {}
+        self._command_values = None
+        self._subscribe_topics = ()
+        self._publish_topics = ()
+        self._availability = None
+
+    async def update_config(self, timeout: float = None):
         """Get the config from main once available."""
         self.homeassistant_config = await self._main.get_ha_config(
-            self._device_key, self._dp_key
+            self._device_key, self._dp_key, timeout
         )
         self.component_config = await self._main.get_ha_component(
+            self.data_point["device_component"], timeout
+        )
+        self.is_valid()
+
+    def load_config(self):
+        """Take the config main already received, if any."""
+        homeassistant_config = self._main.get_cached_ha_config(
+            self._device_key, self._dp_key
+        )
+        component_config = self._main.get_cached_ha_component(
             self.data_point["device_component"]
         )
+        if homeassistant_config is not None:
+            self.homeassistant_config = homeassistant_config
+        if component_config is not None:
+            self.component_config = component_config
         self.is_valid()
 
+    def is_config_ready(self) -> bool:
+        """Return true if main received all config of the datapoint."""
+        return (
+            self._main.get_cached_ha_config(self._device_key, self._dp_key) is not None
+            and self._main.get_cached_ha_component(self.data_point["device_component"])
+            is not None
+        )
+
     def set_homeassistant_config(self, config):
         """Set the Home Assistant datapoint config."""
         self.homeassistant_config = config
@@ -67,113 +174,125 @@ class TransformDataPoint:
             return self._is_valid
         # TODO: check is_valid device
         self._is_valid = True
+        self._compile()
         return self._is_valid
 
-    def set_data(self, data: bytes):
-        """Set value for command."""
-        self._command_value = data.decode("utf-8")
+    def _compile(self):
+        """Use the lookup tables of the component, built once per config."""
+        key = (self.data_point["device_component"], self.data_point["device_topic"])
+        compiled = _COMPILED.get(key)
+        if compiled is None or compiled[0] is not self.component_config:
+            compiled = (
+                self.component_config,
+                _compile(self.component_config, self.data_point["device_topic"]),
+            )
+            _COMPILED[key] = compiled
+        (
+            self._topics_by_type,
+            self._topic_by_type_and_name,
+            self._topic_values,
+            self._command_values,
+        ) = compiled[1]
+        self._resolve_topics()
+
+    def _resolve_topics(self):
+        """Expand the topics of the datapoint, done once per config."""
+        config = self.homeassistant_config
+        base = config.get("~", "")
+        # kept by every datapoint, tuples are smaller than lists
+        self._subscribe_topics = tuple(
+            (config[output_topic["abbreviation"]].replace("~", base), 0)
+            for output_topic in self._get_topics_by_type("subscribe")
+            if output_topic["abbreviation"] in config
+        )
+        # (topic, value map), the map is None for the attributes topic
+        publish_topics = []
+        for output_topic in self._get_topics_by_type("publish"):
+            if output_topic["abbreviation"] not in config:
+                continue
+            topic = output_topic["default_value"].replace("~", base)
+            if self.data_point["device_topic"] == output_topic["name"]:
+                publish_topics.append((topic, self._value_map(output_topic)))
+            elif output_topic["name"] == "json_attributes_topic":
+                publish_topics.append((topic, None))
+        self._publish_topics = tuple(publish_topics)
+        self._availability = None
+        output_topic = self._get_topic_by_type_and_name("publish", "availability_topic")
+        if output_topic and output_topic["abbreviation"] in config:
+            self._availability = (
+                config[output_topic["abbreviation"]],
+                self._value_map(output_topic),
+            )
+
+    def _value_map(self, output_topic: dict) -> dict:
+        type_and_name = (output_topic["topic_type"], output_topic["name"])
+        return self._topic_values.get(type_and_name, {})
+
+    def set_data(self, data):
+        """Set value for command, bytes or a decoded JSON value."""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        self._command_value = data
 
     def set_output_data(self, data):
         """Set device return value."""
         self._state_data = data
 
-    def set_attribute_data(self, data):
+    def set_attribute_data(self, via: str, changed: bool):
         """Set device attribute value."""
-        self._attribute_data = data
+        if via != self._via or changed != self._changed:
+            self._attribute_payload = None
+        self._via = via
+        self._changed = changed
+
+    def _get_attribute_payload(self) -> bytes:
+        if self._attribute_payload is None:
+            attributes = {}
+            if self._via is not None:
+                attributes = {"via": self._via, "changed": self._changed}
+            self._attribute_payload = codec.compact(codec.dumps(attributes))
+        return self._attribute_payload
 
     def get_gateway_payload(self):
         """Get payload in gateway format."""
-        command_topic_list = list(
-            filter(
-                lambda item: "publish_topic" in item
-                and item["publish_topic"] == self.data_point["device_topic"],
-                self.component_config["topics"],
-            )
-        )
-        if len(command_topic_list) == 0:
-            return
-
-        gw_value_list = list(
-            filter(
-                lambda item: item["default_value"] == self._command_value,
-                command_topic_list[0]["values"],
-            )
-        )
-
-        if len(gw_value_list) == 0:
+        if not self._command_values:
             return
-        return gw_value_list[0]["tuya_value"]
-
-    def _full_topic(self, item: dict):
-
-        full = item.replace("~", self.homeassistant_config["~"])
-        return {
-            "full": full,
-            # "key": self._device_key,
-            "dp_key": self._dp_key,
-            "topic": item.replace("~", ""),
-        }
+        return _lookup(self._command_values, self._command_value)
 
     def _get_topics_by_type(self, topic_type: str) -> list:
 
-        return list(
-            filter(
-                lambda item: item["topic_type"] == topic_type,
-                self.component_config["topics"],
-            )
-        )
+        return self._topics_by_type.get(topic_type, [])
 
     def _get_topic_by_type_and_name(self, topic_type: str, name: str) -> dict:
 
-        filtered = list(
-            filter(
-                lambda item: item["topic_type"] == topic_type and item["name"] == name,
-                self.component_config["topics"],
-            )
-        )
-        return filtered[0]
+        return self._topic_by_type_and_name.get((topic_type, name))
 
     def get_subscribe_topics(self) -> dict:
         """Get the topics to subscribe to for the datapoint."""
-        output_topic_list = self._get_topics_by_type("subscribe")
-        for output_topic in output_topic_list:
-            if output_topic["abbreviation"] not in self.homeassistant_config:
-                continue
-            item = self.homeassistant_config[output_topic["abbreviation"]]
-            yield _subscribe_topic(self._full_topic(item))
+        yield from self._subscribe_topics
 
     def get_publish_availability(self, data: bool):
         """Get the availability topic and ha payload."""
-        output_topic_dict = self._get_topic_by_type_and_name(
-            "publish", "availability_topic"
-        )
-        if not output_topic_dict:
+        if not self._availability:
             return
-        if output_topic_dict["abbreviation"] not in self.homeassistant_config:
-            return
-
-        return {
-            "topic": self.homeassistant_config[output_topic_dict["abbreviation"]],
-            "payload": _get_topic_value(output_topic_dict, data),
-        }
+        topic, value_map = self._availability
+        return {"topic": topic, "payload": _lookup(value_map, data)}
 
-    def get_publish_content(self):
-        """Get the topic and ha payload."""
-        output_topic_list = self._get_topics_by_type("publish")
-        for output_topic in output_topic_list:
+    def is_changed(self) -> bool:
+        """Return true if the device value changed with the last status."""
+        return self._changed
 
-            if output_topic["abbreviation"] not in self.homeassistant_config:
+    def get_publish_content(self, only_changed: bool = False):
+        """Get the topic and ha payload, optionally only when changed."""
+        if only_changed and not self.is_changed():
+            return
+        for topic, value_map in self._publish_topics:
+            if value_map is None:
+                yield {"topic": topic, "payload": self._get_attribute_payload()}
                 continue
-            if self.data_point["device_topic"] == output_topic["name"]:
-
-                topic = self._full_topic(output_topic["default_value"])["full"]
-                payload = _get_topic_value(output_topic, self._state_data)
-                self._command_value = payload
-                yield {"topic": topic, "payload": payload}
-            elif output_topic["name"] == "json_attributes_topic":
-                topic = self._full_topic(output_topic["default_value"])["full"]
-                payload = json.dumps(self._attribute_data)
-                yield {"topic": topic, "payload": payload}
+            payload = _lookup(value_map, self._state_data)
+            self._command_value = payload
+            yield {"topic": topic, "payload": payload}
 
 
 class Transform:
@@ -190,6 +309,8 @@ class Transform:
         self._homeassistant_config = None
         self._raw_gateway_payload = None
         self._raw_device_state = None
+        self._attributes_payload = _EncodedPayload()
+        self._attributes_topic = f"tuya/{device_config['deviceid']}/attributes"
 
         for dp_value in self._device_config["dps"]:
             self._data_points[dp_value["key"]] = TransformDataPoint(
@@ -197,6 +318,28 @@ class Transform:
             )
         # self._is_valid = True
 
+    def update_device_config(self, device_config: dict):
+        """Apply a changed GismoCaster config, unchanged datapoints are kept."""
+        data_points = {}
+        for dp_value in device_config["dps"]:
+            data_point = self._data_points.get(dp_value["key"])
+            if data_point is None or data_point.data_point != dp_value:
+                data_point = TransformDataPoint(
+                    self._main, device_config["deviceid"], dp_value
+                )
+                data_point.load_config()
+            data_points[dp_value["key"]] = data_point
+        self._device_config = device_config
+        self._data_points = data_points
+        self._attributes_payload = _EncodedPayload()
+        self._attributes_topic = f"tuya/{device_config['deviceid']}/attributes"
+
+    def get_component_names(self) -> set:
+        """Return the component names used by the datapoints."""
+        return {
+            data_point.get_component_name() for data_point in self._data_points.values()
+        }
+
     def set_homeassistant_config(self, idx, ha_dict):
         """Pass the HA config to datapoint."""
         if idx in self._data_points:
@@ -208,16 +351,22 @@ class Transform:
             if data_point and component_name == data_point.get_component_name():
                 data_point.set_component_config(payload_dict)
 
-    async def update_config(self):
-        """Trigger data points to pull the config."""
+    async def update_config(self, timeout: float = None):
+        """Trigger data points to pull the config, raises asyncio.TimeoutError."""
         # not the most efficient, but good enough for the task
         for _, dp_value in self._data_points.items():
-            await dp_value.update_config()
+            await dp_value.update_config(timeout)
 
     def is_valid(self) -> bool:
         """Return true if the configuration validated."""
         return self._is_valid
 
+    def is_config_ready(self) -> bool:
+        """Return true if main received the config of every datapoint."""
+        return all(
+            data_point.is_config_ready() for data_point in self._data_points.values()
+        )
+
     def data_point(self, idx: int) -> TransformDataPoint:
         """Return TransformDataPoint."""
         if idx in self._data_points:
@@ -238,44 +387,62 @@ class Transform:
         topic = None
         for _, data_point in self._data_points.items():
             avail_dp = data_point.get_publish_availability(data)
+            if not avail_dp:
+                continue
             avail[avail_dp["topic"]] = avail_dp
             topic = avail_dp["topic"]
         if topic:
-            yield avail[avail_dp["topic"]]
+            yield avail[topic]
 
-    def get_publish_content(self):
+    def is_changed(self) -> bool:
+        """Return true if any device value changed with the last status."""
+        if not self._raw_device_state:
+            return False
+        return any(changed for _, changed in self._raw_device_state.values())
+
+    def get_publish_content(self, only_changed: bool = False):
         """Get publish content for all datapoints."""
         for _, data_point in self._data_points.items():
-            yield from data_point.get_publish_content()
+            yield from data_point.get_publish_content(only_changed)
+        if only_changed and not self.is_changed():
+            return
         # TODO: rewrite once GC is fixed
         yield {
-            "topic": f"tuya/{self._device_config['deviceid']}/attributes",
-            "payload": json.dumps(self._raw_gateway_payload),
+            "topic": self._attributes_topic,
+            "payload": self._attributes_payload.encode(self._raw_gateway_payload),
         }
 
     def set_input_payload(self, topic_parts: list, message):
         """Set the incomming data to the data points.
 
         message: can be str value or dict of str value
+        Returns the indexes of the datapoints that were set.
         """
 
         # we don't really know the topic structure
         # assume GC ha config was used to gen the message
 
         if isinstance(message, dict):
-            # TODO: use map
-            for idx, item in message:
+            indexes = []
+            for idx, item in message.items():
+                if not str(idx).isnumeric() or int(idx) not in self._data_points:
+                    continue
                 self._data_points[int(idx)].set_data(item)
-            return
+                indexes.append(int(idx))
+            return indexes
 
         if isinstance(message, bytes) and topic_parts[len(topic_parts) - 2].isnumeric():
             idx = int(topic_parts[len(topic_parts) - 2])
             self._data_points[idx].set_data(message)
+            return [idx]
+        return []
 
-    def get_gateway_payload(self) -> dict:
-        """Get the data gateway format."""
+    def get_gateway_payload(self, indexes=None) -> dict:
+        """Get the data gateway format, of the given datapoints if any."""
         dict_values = {}
         for idx, data_point in self._data_points.items():
+            if indexes is not None and idx not in indexes:
+                continue
             dict_values[idx] = data_point.get_gateway_payload()
         return dict_values
 
@@ -287,13 +454,13 @@ class Transform:
                 self._data_points[idx].set_output_data(gw_dp_payload)
 
     def set_device_state(self, device_state: dict):
-        """Set the device state."""
+        """Set the device state, datapoint -> (via, changed)."""
         self._raw_device_state = device_state
-        for idx, dp_device_state in device_state.items():
+        for idx, (via, changed) in device_state.items():
             if idx in self._data_points:
-                self._data_points[idx].set_attribute_data(dp_device_state)
+                self._data_points[idx].set_attribute_data(via, changed)
 
-    def get_output_payload(self) -> dict:
+    def get_output_payload(self, only_changed: bool = False) -> dict:
         """Get publish content for all datapoints."""
         for _, data_point in self._data_points.items():
-            yield from data_point.get_publish_content()
+            yield from data_point.get_publish_content(only_changed)